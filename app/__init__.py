@@ -17,10 +17,15 @@ from flask_sso import SSO
 from sqlalchemy import create_engine
 from sqlalchemy_utils import create_database, database_exists, drop_database
 
+from app.compression import Compression
 from app.elastic_index import ElasticIndex
 from app.email_service import EmailService
 from app.file_server import FileServer
 from app.rest_exception import RestException
+from app.password_hasher import PasswordHasher
+from app.principal_cache import PrincipalCache
+from app.response_encoder import ResponseEncoder
+from app.search_cache import SearchCache
 
 app = Flask(__name__, instance_relative_config=True)
 
@@ -36,7 +41,8 @@ if(app.config['DEBUG']):
 
 # Enable CORS
 if(app.config['CORS_ENABLED']):
-    cors = CORS(app, resources={r"*": {"origins": "*"}})
+    cors = CORS(app, resources={r"*": {"origins": "*"}},
+                expose_headers=['Link', 'X-Total-Count'])
 
 # Database Configuration
 logging.basicConfig()
@@ -53,6 +59,16 @@ migrate = Migrate(app, db)
 
 # Search System
 elastic_index = ElasticIndex(app)
+search_cache = SearchCache(app)
+
+# Authenticated users, by id
+principal_cache = PrincipalCache(app)
+
+# JSON encoding of API responses
+response_encoder = ResponseEncoder(app)
+
+# gzip / brotli compression of responses
+compression = Compression(app)
 
 # file Server
 file_server = FileServer(app)
@@ -68,6 +84,7 @@ auth = HTTPTokenAuth('Bearer')
 
 # Password Encryption
 bcrypt = Bcrypt(app)
+password_hasher = PasswordHasher(app, bcrypt)
 
 
 @app.cli.command()
@@ -118,12 +135,12 @@ def _load_data(data_loader):
     data_loader.load_user_favorites()
 
 
-def _loadicons():
+def _loadicons(threads=8):
     """Load the SVG icon images onto the S3 bucket and create records in the database"""
     click.echo('Loading SVG Images to S3, creating Icon Records')
     from app import data_loader
     data_loader = data_loader.DataLoader()
-    data_loader.load_icons()
+    data_loader.load_icons(thread_count=threads)
 
 
 def _loaddb():
@@ -133,12 +150,16 @@ def _loaddb():
     _load_data(data_loader)
 
 
-def _loadindex():
+def _loadindex(chunk_size=None, threads=None, since=None, incremental=False):
     """Load all information into the elastic search Index."""
-    click.echo('Loading data into Elastic Search')
     from app import data_loader
     data_loader = data_loader.DataLoader()
-    data_loader.build_index()
+    if since or incremental:
+        click.echo('Syncing changed data into Elastic Search')
+        data_loader.sync_index(since=since, batch_size=chunk_size, thread_count=threads)
+    else:
+        click.echo('Loading data into Elastic Search')
+        data_loader.build_index(batch_size=chunk_size, thread_count=threads)
 
 
 def _clearindex():
@@ -213,8 +234,10 @@ def resetapp():
 
 
 @app.cli.command()
-def loadicons():
-    _loadicons()
+@click.option('--threads', type=int, default=8,
+              help='Number of icons uploaded in parallel.')
+def loadicons(threads):
+    _loadicons(threads)
 
 
 @app.cli.command()
@@ -223,8 +246,102 @@ def initdb():
 
 
 @app.cli.command()
-def initindex():
-    _loadindex()
+@click.option('--chunk-size', type=int, default=None,
+              help='Number of resources sent in each bulk request.')
+@click.option('--threads', type=int, default=None,
+              help='Number of bulk requests sent in parallel.')
+@click.option('--since', type=click.DateTime(), default=None,
+              help='Only index resources updated after this time.')
+@click.option('--incremental', is_flag=True,
+              help='Only index resources updated since the last successful sync.')
+def initindex(chunk_size, threads, since, incremental):
+    _loadindex(chunk_size, threads, since, incremental)
+
+
+@app.cli.command()
+@click.option('--keep', type=int, default=2,
+              help='Number of previous indices to keep for rollback.')
+@click.option('--chunk-size', type=int, default=None,
+              help='Number of resources sent in each bulk request.')
+@click.option('--threads', type=int, default=None,
+              help='Number of bulk requests sent in parallel.')
+def reindex(keep, chunk_size, threads):
+    """Rebuild the search index in a new index and swap it in once complete."""
+    click.echo('Rebuilding the Elastic Search index')
+    from app import data_loader
+    data_loader = data_loader.DataLoader()
+    data_loader.reindex(keep=keep, batch_size=chunk_size, thread_count=threads)
+
+
+@app.cli.command()
+@click.option('--once', is_flag=True,
+              help='Apply everything that is due and exit.')
+@click.option('--requeue-dead', is_flag=True,
+              help='Retry dead-lettered changes before starting.')
+def indexworker(once, requeue_dead):
+    """Apply queued resource changes to the search index."""
+    from app.index_outbox import IndexOutboxWorker
+    worker = IndexOutboxWorker()
+    if requeue_dead:
+        click.echo('Requeued %i dead-lettered changes' % worker.requeue_dead())
+    if once:
+        click.echo('Applied %i index changes' % worker.drain())
+    else:
+        worker.run()
+
+
+@app.cli.command()
+def indexstatus():
+    """Report the size and lag of the search index outbox."""
+    from app.index_outbox import IndexOutboxWorker
+    status = IndexOutboxWorker().status()
+    click.echo('%(pending)i pending, %(dead)i dead, lag %(lag_seconds).1f seconds' % status)
+
+
+@app.cli.command()
+def rollbackindex():
+    """Point search back at the previous index."""
+    from app.model_events import bump_version
+    index_name = elastic_index.rollback()
+    bump_version(db.session, 'search_index')
+    db.session.commit()
+    click.echo('Search now served from %s' % index_name)
+
+
+@app.cli.command()
+def categorypaths():
+    """Recompute the materialized path of every category."""
+    from app.models import rebuild_category_paths
+    rebuild_category_paths(db.session)
+    db.session.commit()
+    click.echo('Category paths rebuilt')
+
+
+@app.cli.command()
+def favoritecounts():
+    """Recount the favorites of every resource."""
+    from app.models import bump_resource_versions, update_favorite_counts
+    update_favorite_counts(db.session)
+    bump_resource_versions(db.session)
+    db.session.commit()
+    click.echo('Favorite counts rebuilt')
+
+
+@app.cli.command()
+@click.option('--scale', type=int, default=100,
+              help='Number of copies of the resources to serialize.')
+def benchmarkjson(scale):
+    """Compare the time taken to serialize resources by each response encoder."""
+    from app.hydration import resource_load_options
+    from app.models import ThrivResource
+    from app.resources.schema import ThrivResourceSchema
+    from app.response_encoder import benchmark
+    resources = db.session.query(ThrivResource).options(*resource_load_options()).all()
+    click.echo('Serializing %i resources %i times over' % (len(resources), scale))
+    with app.test_request_context():
+        results = benchmark(response_encoder, ThrivResourceSchema(many=True), resources * scale)
+    for name, seconds, size in results:
+        click.echo('%-24s %8.3fs %s' % (name, seconds, '%i bytes' % size if size else ''))
 
 
 @app.cli.command()
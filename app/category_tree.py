@@ -0,0 +1,46 @@
+import threading
+
+from flask import Response
+
+from app import response_encoder
+from app.model_events import current_version
+from app.models import Category
+from app.resources.schema import CategorySchema
+
+
+class CategoryTreeSnapshot:
+    """Holds the serialized category tree in memory.  The tree rarely changes, so it is
+    rebuilt only when the category_tree data version moves on
+    (see app.models), which costs one small query per request to check."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self.body = None
+
+    def _build(self):
+        categories = Category.load_tree()
+        data = CategorySchema(many=True).dump(categories).data
+        return response_encoder.dumps(data)
+
+    def refresh(self):
+        """Returns the current (version, body), rebuilding the body if it is out of date."""
+        version = current_version('category_tree')
+        with self._lock:
+            if version != self.version:
+                self.body = self._build()
+                self.version = version
+            return self.version, self.body
+
+    def invalidate(self):
+        """Forces a rebuild on the next request, for when the database is recreated."""
+        with self._lock:
+            self.version = None
+
+    def response(self):
+        """The tree as a JSON response."""
+        version, body = self.refresh()
+        return Response(body, mimetype='application/json')
+
+
+category_tree = CategoryTreeSnapshot()
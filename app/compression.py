@@ -0,0 +1,114 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compression:
+    """Compresses responses with brotli or gzip, whichever the client prefers (brotli
+    winning ties, when the brotli package is installed).  Bodies smaller than min_size
+    are sent as they are, and streamed responses are compressed as they are sent.
+
+    Responses that are the same for everyone who asks - a strong ETag and a public
+    Cache-Control, as the conditional() endpoints send - are compressed once per version,
+    the compressed bytes being kept in an LRU cache of cache_size entries.  Compressed
+    responses carry a weak ETag, which still matches If-None-Match."""
+
+    MIMETYPES = {'application/json', 'application/javascript', 'image/svg+xml',
+                 'text/css', 'text/csv', 'text/html', 'text/plain'}
+
+    def __init__(self, app):
+        settings = app.config.get('COMPRESSION', {})
+        self.min_size = settings.get('min_size', 1024)
+        self.gzip_level = settings.get('gzip_level', 6)
+        self.brotli_quality = settings.get('brotli_quality', 5)
+        self.cache_size = settings.get('cache_size', 64)
+        self.encodings = ('br', 'gzip') if brotli is not None else ('gzip',)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        app.after_request(self.compress)
+
+    def negotiate(self):
+        """The encoding to use for the current request, or None to send it as it is."""
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = request.accept_encodings.quality(encoding)
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def compress(self, response):
+        if response.mimetype not in self.MIMETYPES \
+                or response.status_code < 200 or response.status_code in (204, 206, 304) \
+                or response.direct_passthrough or 'Content-Encoding' in response.headers:
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+        if response.is_streamed:
+            response.response = self._stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            response.set_data(self._cached(response, body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def _compressor(self, encoding):
+        """The (compress, finish) functions of a new compressor for the encoding."""
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            return compressor.process, compressor.finish
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress, compressor.flush
+
+    def _compress(self, body, encoding):
+        compress, finish = self._compressor(encoding)
+        return compress(body) + finish()
+
+    def _stream(self, chunks, encoding):
+        compress, finish = self._compressor(encoding)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            data = compress(chunk)
+            if data:
+                yield data
+        yield finish()
+
+    def _cached(self, response, body, encoding):
+        etag, weak = response.get_etag()
+        if not etag or weak or not response.cache_control.public or self.cache_size <= 0:
+            return self._compress(body, encoding)
+        key = (request.full_path, etag, encoding)
+        with self._lock:
+            compressed = self._cache.get(key)
+            if compressed is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+                return compressed
+            self.misses += 1
+        compressed = self._compress(body, encoding)
+        with self._lock:
+            self._cache[key] = compressed
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return compressed
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._cache), 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,71 @@
+import hashlib
+from functools import wraps
+
+from flask import Response, after_this_request, g, request
+from werkzeug.http import is_resource_modified
+
+from app import db
+
+
+def current_versions(names):
+    """The (version, last_updated) of each named data version, in one query."""
+    from app.models import DataVersion
+    rows = db.session.query(DataVersion.name, DataVersion.version, DataVersion.last_updated)\
+        .filter(DataVersion.name.in_(names))\
+        .all()
+    found = {name: (version, last_updated) for name, version, last_updated in rows}
+    return [found.get(name, (0, None)) for name in names]
+
+
+def conditional(*versions, validator=None, cache_control='no-cache', per_user=False):
+    """Adds an ETag, Last-Modified and Cache-Control header to the responses of a GET
+    method, and answers a matching If-None-Match or If-Modified-Since with a 304 without
+    calling it.  Validators come from the named data versions (see
+    app.model_events.track_version), so checking them costs a single query however
+    large the response is.  Responses that depend on who is asking should set per_user,
+    which makes the ETag differ for each user and role, and should go below
+    login_optional or login_required so the user is known.
+
+    Responses for a single item can give a validator, called with the URL's values,
+    that returns something which changes with the item, such as its own version, or
+    None if there is no such item.  Its value goes into the ETag, so one item changing
+    leaves the others' alone.  It has no time to go with it, so Last-Modified is left
+    out and only If-None-Match is answered."""
+    def decorator(method):
+        @wraps(method)
+        def decorated(*args, **kwargs):
+            current = current_versions(versions)
+            key = ['%s:%i' % (name, version) for name, (version, _) in zip(versions, current)]
+            if validator is not None:
+                item = validator(**kwargs)
+                if item is None:
+                    return method(*args, **kwargs)
+                key.append('item:%s' % (item,))
+            if per_user:
+                user = g.user if 'user' in g and g.user else None
+                key.append('%s:%s:%s' % (user.id, user.role, user.institution_id)
+                           if user else 'anonymous')
+            etag = hashlib.sha1(';'.join(key).encode('utf-8')).hexdigest()
+            modified = [last_updated for _, last_updated in current if last_updated]
+            last_modified = max(modified) if modified and validator is None else None
+
+            def add_validators(response):
+                response.set_etag(etag)
+                response.last_modified = last_modified
+                response.headers['Cache-Control'] = cache_control
+                if per_user:
+                    response.vary.add('Authorization')
+                return response
+
+            if not is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+                return add_validators(Response(status=304))
+
+            @after_this_request
+            def validate(response):
+                if response.status_code == 200:
+                    add_validators(response)
+                return response
+
+            return method(*args, **kwargs)
+        return decorated
+    return decorator
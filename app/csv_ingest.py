@@ -0,0 +1,156 @@
+import csv
+import itertools
+import json
+import os
+from collections import namedtuple
+
+Record = namedtuple('Record', ['line', 'row', 'values'])
+
+
+def text(value):
+    return value
+
+
+def integer(value):
+    try:
+        return int(value.strip())
+    except ValueError:
+        raise ValueError('"%s" is not a whole number' % value)
+
+
+def flag(value):
+    """yes / true or no / false, in any case."""
+    value = value.strip().lower()
+    if value in ('yes', 'true'):
+        return True
+    if value in ('no', 'false'):
+        return False
+    raise ValueError('"%s" is not yes or no' % value)
+
+
+class Column:
+    """A typed column of a CSV file, found by its header (ignoring case and surrounding
+    spaces).  A blank cell is None, which is an error if the column is required.  A
+    repeated column gathers the non-blank cells of every column with that header into a
+    list."""
+
+    def __init__(self, header, name, type=text, required=False, repeated=False):
+        self.header = header
+        self.name = name
+        self.type = type
+        self.required = required
+        self.repeated = repeated
+
+    def parse(self, cells):
+        if self.repeated:
+            return [self.type(cell) for cell in cells if cell.strip()]
+        cell = cells[0] if cells else ''
+        if not cell.strip():
+            if self.required:
+                raise ValueError('is required')
+            return None
+        return self.type(cell)
+
+
+def _normalize(header):
+    return header.strip().lower()
+
+
+class CsvIngest:
+    """Reads a CSV file a chunk of rows at a time, so files of any size can be loaded in
+    bounded memory.  Cells are found by header name rather than position and converted
+    by the given Columns, along with a Column made by other(header) for each header none
+    of them read, if other is given.  Rows that fail, or that the caller rejects, are
+    written to errors_path with their line number and the reasons, and are left out of
+    the chunks.  The error file is only created if there is something to put in it."""
+
+    def __init__(self, path, columns, chunk_size=10000, errors_path=None, other=None):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.errors_path = errors_path or path + '.rejects.csv'
+        self.accepted = 0
+        self.rejected = 0
+        self._errors = None
+        self._error_writer = None
+        self._file = open(path, newline='')
+        self._reader = csv.reader(self._file, delimiter=csv.excel.delimiter,
+                                  quotechar=csv.excel.quotechar)
+        self.header = next(self._reader, [])
+        self._positions = {}
+        for position, header in enumerate(self.header):
+            self._positions.setdefault(_normalize(header), []).append(position)
+        self._declared = list(columns)
+        self.columns = self._declared + [other(header) for header in self.other_headers()] \
+            if other is not None else self._declared
+        missing = [column.header for column in columns
+                   if column.required and _normalize(column.header) not in self._positions]
+        if missing:
+            self.close()
+            raise ValueError('%s is missing the column(s) %s' % (path, ', '.join(missing)))
+        self._column_positions = [(column, self._positions.get(_normalize(column.header), []))
+                                  for column in self.columns]
+        if os.path.exists(self.errors_path):
+            os.remove(self.errors_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._file.close()
+        if self._errors is not None:
+            self._errors.close()
+            print("Rejected %i rows of %s, see %s" % (self.rejected, self.path, self.errors_path))
+
+    def other_headers(self):
+        """The non-blank headers that none of the given columns read, in order."""
+        known = {_normalize(column.header) for column in self._declared}
+        return [header for header in self.header
+                if header.strip() and _normalize(header) not in known]
+
+    def _records(self):
+        line = self._reader.line_num + 1
+        for row in self._reader:
+            start, line = line, self._reader.line_num + 1
+            if not any(cell.strip() for cell in row):
+                continue
+            values, errors = {}, {}
+            for column, positions in self._column_positions:
+                try:
+                    values[column.name] = column.parse(
+                        [row[position] for position in positions if position < len(row)])
+                except ValueError as error:
+                    errors[column.header] = str(error)
+            if errors:
+                self._write_reject(Record(start, row, values), errors)
+            else:
+                yield Record(start, row, values)
+
+    def chunks(self):
+        """Lists of at most chunk_size valid Records."""
+        records = self._records()
+        while True:
+            chunk = list(itertools.islice(records, self.chunk_size))
+            if not chunk:
+                return
+            self.accepted += len(chunk)
+            yield chunk
+
+    def reject(self, record, errors):
+        """Writes a record taken from a chunk to the error file, errors being a message or
+        a dict of them by column."""
+        self.accepted -= 1
+        self._write_reject(record, errors)
+
+    def _write_reject(self, record, errors):
+        if self._errors is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.errors_path)), exist_ok=True)
+            self._errors = open(self.errors_path, 'w', newline='')
+            self._error_writer = csv.writer(self._errors)
+            self._error_writer.writerow(['line', 'errors'] + self.header)
+        if not isinstance(errors, str):
+            errors = json.dumps(errors, sort_keys=True)
+        self._error_writer.writerow([record.line, errors] + record.row)
+        self.rejected += 1
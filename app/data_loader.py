@@ -1,4 +1,10 @@
+import datetime
+import io
+import mimetypes
+import os
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import magic
 from flask import json
@@ -7,23 +13,116 @@ from app.models import Availability
 from app.models import Category
 from app.models import EmailLog
 from app.models import Icon
+from app.models import IndexSync
 from app.models import ThrivResource
 from app.models import ThrivInstitution
 from app.models import ResourceCategory
+from app.models import ResourceOwner
+from app.models import ResourceTombstone
 from app.models import ThrivType
 from app.models import ThrivSegment
 from app.models import Favorite
+from app.models import bump_resource_versions, update_favorite_counts
 from app import db, elastic_index, file_server
-import csv
+from app.model_events import bump_version, record_changes
+from app.csv_ingest import Column, CsvIngest, flag, integer
+from app.hydration import resource_batches
 
 from app.models import User
 from app.resources.schema import CategorySchema
 
 
+def _copy_value(value):
+    """A value in COPY's text format."""
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t')\
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+class NameLookup:
+    """The ids of a lookup table's rows by name, read with one query.  Rows are added for
+    names that are not there yet."""
+
+    def __init__(self, model):
+        self.model = model
+        self.ids = {name: id for id, name in db.session.query(model.id, model.name)}
+
+    def __getitem__(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            row = self.model(name=name)
+            db.session.add(row)
+            db.session.flush()
+            id = self.ids[name] = row.id
+        return id
+
+
+RESOURCE_COLUMNS = [
+    Column('#', 'id', integer, required=True),
+    Column('Resource', 'name', required=True),
+    Column('Institution', 'institution'),
+    Column('TYPE', 'type'),
+    Column('Public Facing Contact Info (name/phone/email)', 'contact_notes'),
+    Column('Email', 'owner'),
+    Column('Websites', 'website'),
+    Column('Description', 'description'),
+    Column('Segment', 'segment', required=True),
+]
+AVAILABILITY_COLUMNS = [
+    Column('#', 'resource_id', integer, required=True),
+    Column('Resource', 'name'),
+    Column('Primary Institution', 'primary_institution'),
+    Column('Viewable', 'viewable', flag),
+    Column('Cost to Researcher', 'cost'),
+]
+CATEGORY_COLUMNS = [
+    Column('Category ID', 'id', integer, required=True),
+    Column('Parent ID', 'parent_id', integer),
+    Column('Category Name', 'name', required=True),
+    Column('Category Descriptions Short', 'brief_description'),
+    Column('Category Descriptions Long', 'description'),
+    Column('Icon ID', 'icon_id', integer),
+    Column('Color', 'color'),
+    Column('Image', 'image'),
+    Column('Display Order', 'display_order', integer),
+]
+RESOURCE_CATEGORY_COLUMNS = [
+    Column('#', 'resource_id', integer, required=True),
+    Column('Cat #', 'category_ids', integer, repeated=True),
+]
+USER_COLUMNS = [
+    Column('id', 'id', integer, required=True),
+    Column('email_address', 'email', required=True),
+    Column('display_name', 'display_name'),
+    Column('password', 'password'),
+    Column('role', 'role'),
+]
+INSTITUTION_COLUMNS = [
+    Column('id', 'id', integer, required=True),
+    Column('name', 'name', required=True),
+    Column('description', 'description'),
+    Column('domain', 'domain'),
+    Column('hide_availability', 'hide_availability', flag),
+]
+ICON_COLUMNS = [
+    Column('id', 'id', integer, required=True),
+    Column('name', 'name', required=True),
+    Column('local_file', 'local_file', required=True),
+    Column('type', 'type'),
+]
+FAVORITE_COLUMNS = [
+    Column('User#', 'user_id', integer, required=True),
+    Column('Resource #', 'resource_ids', integer, repeated=True),
+]
+
+
 class DataLoader:
-    """Loads CSV files into the database"""
+    """Loads CSV files into the database, a batch_size rows at a time, with the columns
+    found by their headers (see CsvIngest).  The larger files are written with COPY
+    rather than through the ORM."""
 
-    def __init__(self, directory="./example_data"):
+    def __init__(self, directory="./example_data", batch_size=10000, errors_directory=None):
         self.resource_file = directory + "/resources.csv"
         self.availability_file = directory + "/resource_availability.csv"
         self.category_file = directory + "/categories.csv"
@@ -32,188 +131,314 @@ class DataLoader:
         self.user_file = directory + "/users.csv"
         self.user_favorite_file = directory + "/user_favorites.csv"
         self.institution_file = directory + "/institutions.csv"
-        self.mime = magic.Magic(mime=True)
+        self.batch_size = batch_size
+        self.errors_directory = errors_directory
+        self.icon_directory = directory + "/icons"
+        self.mime = None
         print("Data loader initialized")
 
     def load_resources(self):
-        with open(self.resource_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            next(reader, None)  # skip the headers
-            for index, row in enumerate(reader):
-                segment_type = self.get_segment_by_name(
-                    row[11]) if row[11] else None
-                resource_type=self.get_type_by_name(
-                    row[3]) if row[3] else None
-                institution=self.get_inst_by_name(row[2])
-                resource=ThrivResource(id = row[0], name = row[1], description = row[10], segment = segment_type, type = resource_type, institution = institution,
-                                         owner = row[8], website = row[9], contact_notes = row[4])
-                resource.approved="Approved" if (
-                    index % 2 == 0) else "Unapproved"
-                resource.private=(index % 3 == 0)
-                db.session.add(resource)
-            print("Resources loaded.  There are now %i resources in the database." %
-                  db.session.query(ThrivResource).count())
-        db.session.commit()
+        segments = NameLookup(ThrivSegment)
+        types = NameLookup(ThrivType)
+        institutions = NameLookup(ThrivInstitution)
+        resource_ids = {id for (id,) in db.session.query(ThrivResource.id)}
+        now = datetime.datetime.now()
+        columns = ['id', 'name', 'description', 'segment_id', 'type_id', 'institution_id',
+                   'owner', 'website', 'contact_notes', 'approved', 'private', 'last_updated',
+                   'favorite_count']
+        index = 0
+        with self.ingest(self.resource_file, RESOURCE_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                resources = []
+                for record in chunk:
+                    r = record.values
+                    if r['id'] in resource_ids:
+                        ingest.reject(record, 'There is already a resource with id %i' % r['id'])
+                        continue
+                    resource_ids.add(r['id'])
+                    resources.append((r['id'], r['name'], r['description'],
+                                      segments[r['segment']],
+                                      types[r['type']] if r['type'] else None,
+                                      institutions[r['institution']] if r['institution'] else None,
+                                      r['owner'], r['website'], r['contact_notes'],
+                                      "Approved" if (index % 2 == 0) else "Unapproved",
+                                      index % 3 == 0, now, 0))
+                    index += 1
+                self.copy(ThrivResource, columns, resources)
+                self.copy(ResourceOwner, ['resource_id', 'email'],
+                          [(resource[0], email) for resource in resources
+                           for email in ThrivResource.split_owners(resource[6])])
+                self.commit_batch([ThrivResource, ResourceOwner])
         db.session.execute("SELECT setval('resource_id_seq', "
                            "COALESCE((SELECT MAX(id) + 1 FROM resource), 1), false);")
         db.session.commit()
+        print("Resources loaded.  There are now %i resources in the database." %
+              db.session.query(ThrivResource).count())
 
     def load_availability(self):
-        with open(self.availability_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            header = next(reader, None)  # use headers to set availability
-
-            for row in reader:
-                try:
-                    resource = self.get_resource_by_id(row[0])
-                    resource.cost = row[10]
-                except:
-                    print(
-                        "Warning:  Availability references non existing resource id %s, Ignoring." % row[0])
-                    continue
-                for i in range(3, 9):
-                    is_available = row[i].lower().strip(
-                    ) == "yes" or row[i].lower().strip() == "true"
-                    institution = self.get_inst_by_name(header[i])
-                    availability = Availability(resource=resource, institution_id=institution.id,
-                                                available=is_available)
-                    db.session.add(availability)
-            db.session.commit()
-            print("Availability loaded.  There are now %i availability records in the database." %
-                  db.session.query(Availability).count())
-
-    def load_icons(self):
-        with open(self.icon_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            header = next(reader, None)  # use headers to set availability
-            for row in reader:
-                id = eval(row[0])
-                icon = db.session.query(Icon).filter(Icon.id == id).first()
+        """Each column that is not one of AVAILABILITY_COLUMNS names an institution, and
+        holds whether the resource is available to it."""
+        institutions = NameLookup(ThrivInstitution)
+        resource_ids = {id for (id,) in db.session.query(ThrivResource.id)}
+        with self.ingest(self.availability_file, AVAILABILITY_COLUMNS,
+                         other=lambda header: Column(header, header, flag)) as ingest:
+            institution_ids = {header: institutions[header] for header in ingest.other_headers()}
+            for chunk in ingest.chunks():
+                accepted = []
+                for record in chunk:
+                    if record.values['resource_id'] not in resource_ids:
+                        ingest.reject(record, 'There is no resource with id %i' %
+                                      record.values['resource_id'])
+                        continue
+                    accepted.append(record.values)
+                self.copy(Availability, ['resource_id', 'institution_id', 'available'],
+                          [(values['resource_id'], institution_id, bool(values[header]))
+                           for values in accepted
+                           for header, institution_id in institution_ids.items()])
+                self.update(ThrivResource, 'cost',
+                            [(values['resource_id'], values['cost']) for values in accepted])
+                self.commit_batch([Availability, ThrivResource])
+        bump_resource_versions(db.session)
+        db.session.commit()
+        print("Availability loaded.  There are now %i availability records in the database." %
+              db.session.query(Availability).count())
+
+    def load_icons(self, thread_count=8):
+        """Uploads the icons to S3 from a pool of thread_count threads, skipping those S3
+        already holds unchanged, and records them in the database."""
+        started = time.time()
+        with self.ingest(self.icon_file, ICON_COLUMNS) as ingest:
+            records, icon_ids = [], set()
+            for chunk in ingest.chunks():
+                for record in chunk:
+                    if record.values['id'] in icon_ids:
+                        ingest.reject(record, 'The icon with id %i is listed twice' %
+                                      record.values['id'])
+                    elif os.path.isfile(self.icon_path(record)):
+                        icon_ids.add(record.values['id'])
+                        records.append(record)
+                    else:
+                        ingest.reject(record, 'There is no file %s' % self.icon_path(record))
+        icons = {icon.id: icon for icon in db.session.query(Icon).filter(
+            Icon.id.in_([record.values['id'] for record in records]))}
+        mime_types = [self.mime_type(self.icon_path(record)) for record in records]
+
+        uploaded, skipped, size = 0, 0, 0
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            results = executor.map(self.upload_icon, records, mime_types)
+            for record, (url, length, changed) in zip(records, results):
+                icon = icons.get(record.values['id'])
                 if icon is None:
-                    icon = Icon(id=id, name=row[1])
-                path = "./example_data/icons/%s" % row[2]
-                extension = path.rsplit('.', 1)[1].lower()
-                mime_type = self.mime.from_file(path)
-                data = open(path, 'rb')
-                icon.url = file_server.save_icon(
-                    data, icon, extension, mime_type)
+                    icon = Icon(id=record.values['id'], name=record.values['name'])
+                icon.url = url
                 db.session.add(icon)
+                if changed:
+                    uploaded, size = uploaded + 1, size + length
+                else:
+                    skipped += 1
 
                 resource_type = self.get_type_by_name(
-                    row[3]) if row[3] else None
+                    record.values['type']) if record.values['type'] else None
                 if resource_type:
                     resource_type.icon = icon
                     db.session.add(resource_type)
         db.session.commit()
+        elapsed = time.time() - started
+        print("Uploaded %i icons (%.1f KB) in %.1f seconds, %.1f KB/s.  %i were unchanged." %
+              (uploaded, size / 1024, elapsed, size / 1024 / elapsed if elapsed else 0, skipped))
+
+    def icon_path(self, record):
+        return os.path.join(self.icon_directory, record.values['local_file'])
+
+    def upload_icon(self, record, mime_type):
+        """Uploads an icon file if it has changed, returning (url, bytes, uploaded)."""
+        path = self.icon_path(record)
+        extension = path.rsplit('.', 1)[1].lower()
+        with open(path, 'rb') as icon_file:
+            data = icon_file.read()
+        url, uploaded = file_server.sync_icon(
+            data, record.values['id'], extension, mime_type)
+        return url, len(data), uploaded
+
+    def mime_type(self, path):
+        """The mime type of a file, from its extension where that is known and otherwise
+        from its contents."""
+        mime_type = mimetypes.guess_type(path)[0]
+        if mime_type is None:
+            if self.mime is None:
+                self.mime = magic.Magic(mime=True)
+            mime_type = self.mime.from_file(path)
+        return mime_type
 
     def load_categories(self):
-        with open(self.category_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            header = next(reader, None)  # use headers to set availability
-
-            for row in reader:
-                id = eval(row[0])
-                category = Category(
-                    id=id, brief_description=row[4], name=row[3],
-                    description=row[5], color=row[7], image=row[8])
-                if row[2] != '':
-                    parent_id = eval(row[2])
-                    category.parent_id = parent_id
-                if row[6] != '':
-                    icon_id = eval(row[6])
-                    category.icon_id = icon_id
-                if row[9] != '':
-                    display_order = eval(row[9])
-                    category.display_order = display_order
-                db.session.add(category)
-            # As we manually set the ids, we need to update the sequence manually as well.
-            db.session.commit()
-            db.session.execute("SELECT setval('category_id_seq', "
-                               "COALESCE((SELECT MAX(id) + 1 FROM category), 1), false);")
-            db.session.commit()
-            print("Categories.  There are now %i category records in the database." %
-                  db.session.query(Category).count())
+        """Parents must come before their children, and icons be loaded first."""
+        category_ids = {id for (id,) in db.session.query(Category.id)}
+        icon_ids = {id for (id,) in db.session.query(Icon.id)}
+        with self.ingest(self.category_file, CATEGORY_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                for record in chunk:
+                    c = record.values
+                    if c['id'] in category_ids:
+                        ingest.reject(record, 'There is already a category with id %i' % c['id'])
+                        continue
+                    if c['parent_id'] is not None and c['parent_id'] not in category_ids:
+                        ingest.reject(record, 'There is no category with id %i before this one' %
+                                      c['parent_id'])
+                        continue
+                    if c['icon_id'] is not None and c['icon_id'] not in icon_ids:
+                        ingest.reject(record, 'There is no icon with id %i' % c['icon_id'])
+                        continue
+                    category_ids.add(c['id'])
+                    category = Category(
+                        id=c['id'], brief_description=c['brief_description'], name=c['name'],
+                        description=c['description'], color=c['color'], image=c['image'],
+                        parent_id=c['parent_id'], icon_id=c['icon_id'])
+                    if c['display_order'] is not None:
+                        category.display_order = c['display_order']
+                    db.session.add(category)
+                # As we manually set the ids, we need to update the sequence manually as well.
+                db.session.commit()
+        db.session.execute("SELECT setval('category_id_seq', "
+                           "COALESCE((SELECT MAX(id) + 1 FROM category), 1), false);")
+        db.session.commit()
+        print("Categories.  There are now %i category records in the database." %
+              db.session.query(Category).count())
 
     def load_resource_categories(self):
-        with open(self.resource_category_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            next(reader, None)  # use headers to set availability
-
-            for row in reader:
-                for i in range(4, 10):
-                    if not row[i]:
+        resource_ids = {id for (id,) in db.session.query(ThrivResource.id)}
+        category_ids = {id for (id,) in db.session.query(Category.id)}
+        with self.ingest(self.resource_category_file, RESOURCE_CATEGORY_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                links = []
+                for record in chunk:
+                    r = record.values
+                    missing = [id for id in r['category_ids'] if id not in category_ids]
+                    if r['resource_id'] not in resource_ids:
+                        ingest.reject(record, 'There is no resource with id %i' % r['resource_id'])
+                    elif missing:
+                        ingest.reject(record, 'There is no category with id %s' %
+                                      ', '.join(str(id) for id in missing))
+                    else:
+                        links.extend((r['resource_id'], id) for id in r['category_ids'])
+                self.copy(ResourceCategory, ['resource_id', 'category_id'], links)
+                self.commit_batch([ResourceCategory])
+        bump_resource_versions(db.session)
+        db.session.commit()
+        print("There are now %i links between resources and categories in the database." %
+              db.session.query(ResourceCategory).count())
+
+    def load_users(self):
+        user_ids, emails = set(), set()
+        for id, email in db.session.query(User.id, User.email):
+            user_ids.add(id)
+            emails.add(email)
+        with self.ingest(self.user_file, USER_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                for record in chunk:
+                    u = record.values
+                    if u['id'] in user_ids:
+                        ingest.reject(record, 'There is already a user with id %i' % u['id'])
+                        continue
+                    if u['email'] in emails:
+                        ingest.reject(record, 'There is already a user with email %s' % u['email'])
                         continue
-                    resource_id = eval(row[0])
-                    category_id = eval(row[i])
+                    user_ids.add(u['id'])
+                    emails.add(u['email'])
+                    user = User(id=u['id'], eppn=u['email'], email=u['email'],
+                                display_name=u['display_name'], password=u['password'],
+                                role=u['role'], email_verified=True)
+                    db.session.add(user)
+                db.session.commit()
+        db.session.execute("SELECT setval('ithriv_user_id_seq', "
+                           "COALESCE((SELECT MAX(id) + 1 FROM ithriv_user), 1), false);")
+        db.session.commit()
+        print("There are now %i users in the database." %
+              db.session.query(User).count())
 
-                    resource_category = ResourceCategory(resource_id=resource_id,
-                                                         category_id=category_id)
-                    db.session.add(resource_category)
-            db.session.commit()
-            print("There are now %i links between resources and categories in the database." %
-                  db.session.query(ResourceCategory).count())
+    def load_institutions(self):
+        institution_ids = {id for (id,) in db.session.query(ThrivInstitution.id)}
+        with self.ingest(self.institution_file, INSTITUTION_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                for record in chunk:
+                    i = record.values
+                    if i['id'] in institution_ids:
+                        ingest.reject(record, 'There is already an institution with id %i' % i['id'])
+                        continue
+                    institution_ids.add(i['id'])
+                    inst = ThrivInstitution(
+                        id=i['id'], name=i['name'], description=i['description'],
+                        domain=i['domain'], hide_availability=bool(i['hide_availability']))
+                    db.session.add(inst)
+                db.session.commit()
+        db.session.execute("SELECT setval('institution_id_seq', "
+                           "COALESCE((SELECT MAX(id) + 1 FROM institution), 1), false);")
+        db.session.commit()
+        print("There are now %i institutions in the database." %
+              db.session.query(ThrivInstitution).count())
 
-    def load_users(self):
-        with open(self.user_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            next(reader, None)  # use headers to set availability
+    def load_user_favorites(self):
+        user_ids = {id for (id,) in db.session.query(User.id)}
+        resource_ids = {id for (id,) in db.session.query(ThrivResource.id)}
+        with self.ingest(self.user_favorite_file, FAVORITE_COLUMNS) as ingest:
+            for chunk in ingest.chunks():
+                favorites = []
+                for record in chunk:
+                    f = record.values
+                    missing = [id for id in f['resource_ids'] if id not in resource_ids]
+                    if f['user_id'] not in user_ids:
+                        ingest.reject(record, 'There is no user with id %i' % f['user_id'])
+                    elif missing:
+                        ingest.reject(record, 'There is no resource with id %s' %
+                                      ', '.join(str(id) for id in missing))
+                    else:
+                        favorites.extend((f['user_id'], id) for id in f['resource_ids'])
+                self.copy(Favorite, ['user_id', 'resource_id'], favorites)
+                self.commit_batch([Favorite])
+        update_favorite_counts(db.session)
+        bump_resource_versions(db.session)
+        db.session.commit()
+        print("Favorites Loaded. There are now %i links between users and resources in the database." %
+              db.session.query(Favorite).count())
 
-            for row in reader:
-                user = User(id=row[0], eppn=row[1], email=row[1], display_name=row[2], password=row[3], role=row[4],
-                            email_verified=True)
+    def ingest(self, path, columns, other=None):
+        """Reads a CSV file a batch_size rows at a time, see CsvIngest.  Rejected rows go
+        to a .rejects.csv file in errors_directory, if one was given, or beside the file."""
+        errors_path = None
+        if self.errors_directory:
+            errors_path = os.path.join(self.errors_directory,
+                                       os.path.basename(path) + '.rejects.csv')
+        return CsvIngest(path, columns, chunk_size=self.batch_size, errors_path=errors_path,
+                         other=other)
 
-                db.session.add(user)
-            db.session.commit()
-            db.session.execute("SELECT setval('ithriv_user_id_seq', "
-                               "COALESCE((SELECT MAX(id) + 1 FROM ithriv_user), 1), false);")
-            db.session.commit()
-            print("There are now %i users in the database." %
-                  db.session.query(User).count())
+    def copy(self, model, columns, rows):
+        """Writes rows, as tuples of values for the given columns, into the model's table
+        with a single COPY, bypassing the ORM."""
+        self._copy(model.__tablename__, columns, rows)
 
-    def load_institutions(self):
-        with open(self.institution_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            next(reader, None)  # use headers to set availability
-
-            for row in reader:
-                inst = ThrivInstitution(
-                    id=row[0], name=row[1], description=row[2], domain=row[3])
-                if row[4] == 'True':
-                    inst.hide_availability = True
-                db.session.add(inst)
-            db.session.commit()
-            db.session.execute("SELECT setval('institution_id_seq', "
-                               "COALESCE((SELECT MAX(id) + 1 FROM institution), 1), false);")
-            db.session.commit()
-            print("There are now %i institutions in the database." %
-                  db.session.query(ThrivInstitution).count())
+    @staticmethod
+    def _copy(table, columns, rows):
+        buffer = io.StringIO()
+        for row in rows:
+            buffer.write('\t'.join(_copy_value(value) for value in row) + '\n')
+        buffer.seek(0)
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)), buffer)
 
-    def load_user_favorites(self):
-        with open(self.user_favorite_file, newline='') as csvfile:
-            reader = csv.reader(
-                csvfile, delimiter=csv.excel.delimiter, quotechar=csv.excel.quotechar)
-            next(reader, None)  # use headers to set availability
-
-            for row in reader:
-                for i in range(1, 7):
-                    if not row[i]:
-                        continue
-                    user_id = eval(row[0])
-                    resource_id = eval(row[i])
+    def update(self, model, column, values):
+        """Sets a column of the model's table from (id, value) pairs, with a COPY into a
+        temporary table and one UPDATE."""
+        db.session.execute('CREATE TEMPORARY TABLE bulk_update (id integer, value varchar) '
+                           'ON COMMIT DROP')
+        self._copy('bulk_update', ['id', 'value'], values)
+        db.session.execute('UPDATE %(table)s SET %(column)s = bulk_update.value FROM bulk_update '
+                           'WHERE %(table)s.id = bulk_update.id' %
+                           {'table': model.__tablename__, 'column': column})
 
-                    user_favorite = Favorite(user_id=user_id,
-                                             resource_id=resource_id)
-                    db.session.add(user_favorite)
-            db.session.commit()
-            print("Favorites Loaded. There are now %i links between users and resources in the database." %
-                  db.session.query(Favorite).count())
+    def commit_batch(self, models):
+        """Commits rows written with copy or update, moving on the data versions of the
+        models written (see app.model_events)."""
+        record_changes(db.session, models)
+        db.session.commit()
 
     def get_resource_by_id(self, id):
         resource = db.session.query(ThrivResource).filter(
@@ -246,17 +471,108 @@ class DataLoader:
             db.session.add(segment)
         return segment
 
-    def build_index(self):
-        elastic_index.load_resources(db.session.query(ThrivResource).all())
+    def build_index(self, batch_size=None, thread_count=None):
+        batch_size = batch_size or elastic_index.bulk_chunk_size
+        started = datetime.datetime.now()
+        indexed, failed = elastic_index.load_resources(
+            resource_batches(batch_size), thread_count=thread_count)
+        if not failed:
+            self.save_index_watermark(started)
+
+    def get_index_watermark(self):
+        watermark = db.session.query(IndexSync).filter(
+            IndexSync.index_name == elastic_index.resource_index_name).first()
+        return watermark.synced_at if watermark else None
+
+    def save_index_watermark(self, synced_at):
+        watermark = db.session.query(IndexSync).filter(
+            IndexSync.index_name == elastic_index.resource_index_name).first()
+        if watermark is None:
+            watermark = IndexSync(index_name=elastic_index.resource_index_name)
+        elif watermark.synced_at is not None:
+            # Tombstones from before the previous sync have been applied twice over
+            db.session.query(ResourceTombstone)\
+                .filter(ResourceTombstone.deleted < watermark.synced_at)\
+                .delete(synchronize_session=False)
+        watermark.synced_at = synced_at
+        db.session.add(watermark)
+        bump_version(db.session, 'search_index')
+        db.session.commit()
+
+    def sync_index(self, since=None, batch_size=None, thread_count=None):
+        """Brings the index up to date with the database without a full rebuild.  Resources
+        updated since the given time (or since the last successful sync) are upserted,
+        and those deleted since then, as recorded by their tombstones, are removed.  The
+        watermark only advances when every document was written, so failures are retried
+        next run."""
+        batch_size = batch_size or elastic_index.bulk_chunk_size
+        started = datetime.datetime.now()
+        since = since or self.get_index_watermark()
+
+        query = db.session.query(ThrivResource)
+        if since is not None:
+            query = query.filter(ThrivResource.last_updated >= since)
+            print("Syncing resources updated since %s" % since)
+        indexed, failed = elastic_index.load_resources(
+            resource_batches(batch_size, query), thread_count=thread_count)
+
+        tombstones = db.session.query(ResourceTombstone.resource_id)
+        if since is not None:
+            tombstones = tombstones.filter(ResourceTombstone.deleted >= since)
+        deleted = {id for (id,) in tombstones}
+        failed_removals = elastic_index.remove_resources(deleted)
+        print("Removed %i deleted resources from the index, %i errors." %
+              (len(deleted) - len(failed_removals), len(failed_removals)))
+
+        if not failed and not failed_removals:
+            self.save_index_watermark(started)
+        return indexed, len(deleted) - len(failed_removals)
+
+    def reindex(self, keep=2, batch_size=None, thread_count=None):
+        """Builds a fresh index alongside the live one, verifies it against the database and
+        then swaps the search alias over to it, so searches are never served from a partial
+        index.  The `keep` most recent old indices are retained for rollback."""
+        batch_size = batch_size or elastic_index.bulk_chunk_size
+        started = datetime.datetime.now()
+        index_name = elastic_index.create_versioned_index()
+        indexed, failed = elastic_index.load_resources(
+            resource_batches(batch_size), thread_count=thread_count, index_name=index_name)
+
+        # Pick up anything written through the API while the bulk load was running.
+        changed = db.session.query(ThrivResource).filter(ThrivResource.last_updated >= started)
+        elastic_index.load_resources(
+            resource_batches(batch_size, changed), thread_count=thread_count, index_name=index_name)
+
+        expected = db.session.query(ThrivResource).count()
+        actual = elastic_index.document_count(index_name)
+        if failed or actual != expected:
+            elastic_index.drop_index(index_name)
+            raise Exception("Reindex aborted: %s holds %i documents but there are %i resources "
+                            "(%i errors).  The live index was left in place." %
+                            (index_name, actual, expected, failed))
+        elastic_index.swap_alias(index_name)
+        elastic_index.prune_indices(keep)
+        self.save_index_watermark(started)
+        print("Search now served from %s with %i resources." % (index_name, actual))
+        return index_name
 
     def clear_index(self):
         print("Clearing the index")
         elastic_index.clear()
+        try:
+            db.session.query(IndexSync).filter(
+                IndexSync.index_name == elastic_index.resource_index_name).delete()
+            bump_version(db.session, 'search_index')
+            db.session.commit()
+        except:
+            db.session.rollback()
+            print("No index watermark to reset, the database may not exist.")
 
     def clear(self):
         db.session.query(ResourceCategory).delete()
         db.session.query(Availability).delete()
         db.session.query(Favorite).delete()
+        db.session.query(ResourceOwner).delete()
         db.session.query(ThrivResource).delete()
         db.session.query(ThrivType).delete()
         db.session.query(Category).delete()
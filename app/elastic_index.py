@@ -1,8 +1,11 @@
+import datetime
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Any, Union
 
 import elasticsearch_dsl
-from elasticsearch import Elasticsearch
+from elasticsearch import helpers
 from elasticsearch_dsl import Boolean, DocType, Date, Keyword, Text, \
     Index, analyzer, Integer, Q, tokenizer
 from elasticsearch_dsl.connections import connections
@@ -20,11 +23,13 @@ class ElasticIndex:
         self.index_prefix = app.config['ELASTIC_SEARCH']["index_prefix"]
 
         self.resource_index_name = '%s_resource' % self.index_prefix
+        self.bulk_chunk_size = app.config['ELASTIC_SEARCH'].get('bulk_chunk_size', 500)
+        self.bulk_thread_count = app.config['ELASTIC_SEARCH'].get('bulk_thread_count', 4)
         self.resource_index = Index(self.resource_index_name)
         self.resource_index.doc_type(ElasticResource)
 
         try:
-            ElasticResource.init()
+            self.ensure_index()
         except:
             self.logger.info(
                 "Failed to create the index(s).  They may already exist.")
@@ -50,14 +55,82 @@ class ElasticIndex:
         """Establish connection to an ElasticSearch host, and initialize the Submission collection"""
         self.connection = self.__get_connection(settings)
 
+    def ensure_index(self):
+        """The resource index name is an alias that points at a timestamped index, so that
+        the index can be rebuilt and swapped in without interrupting searches.  Creates the
+        first index and alias if there is nothing there yet."""
+        if self.connection.indices.exists(index=self.resource_index_name):
+            ElasticResource.init()
+        else:
+            self.swap_alias(self.create_versioned_index())
+
+    def create_versioned_index(self):
+        name = '%s_%s' % (self.resource_index_name,
+                          datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S%f'))
+        index = Index(name)
+        index.doc_type(ElasticResource)
+        index.create()
+        self.logger.info("Created index %s" % name)
+        return name
+
+    def versioned_indices(self):
+        """All timestamped resource indices, oldest first."""
+        indices = self.connection.indices.get(
+            index='%s_*' % self.resource_index_name, ignore=404)
+        return sorted(name for name in indices if name not in ('error', 'status'))
+
+    def aliased_indices(self):
+        """The indices the resource alias currently points at."""
+        if not self.connection.indices.exists_alias(name=self.resource_index_name):
+            return []
+        return list(self.connection.indices.get_alias(name=self.resource_index_name))
+
+    def document_count(self, index_name):
+        self.connection.indices.refresh(index=index_name)
+        return self.connection.count(index=index_name)['count']
+
+    def swap_alias(self, index_name):
+        """Atomically points the resource alias at the given index.  An index created before
+        aliases were in use, which holds the alias name itself, is removed in the same call."""
+        actions = [{'remove': {'index': name, 'alias': self.resource_index_name}}
+                   for name in self.aliased_indices()]
+        actions.append({'add': {'index': index_name, 'alias': self.resource_index_name}})
+        if self.connection.indices.exists(index=self.resource_index_name) and \
+                not self.connection.indices.exists_alias(name=self.resource_index_name):
+            actions.append({'remove_index': {'index': self.resource_index_name}})
+        self.connection.indices.update_aliases(body={'actions': actions})
+        self.logger.info("Alias %s now points at %s" % (self.resource_index_name, index_name))
+
+    def prune_indices(self, keep):
+        """Deletes old resource indices, keeping the live one plus the newest `keep` others
+        for rollback."""
+        live = self.aliased_indices()
+        older = [name for name in self.versioned_indices() if name not in live]
+        stale = older[:-keep] if keep > 0 else older
+        for name in stale:
+            self.connection.indices.delete(index=name, ignore=[400, 404])
+            self.logger.info("Deleted old index %s" % name)
+        return stale
+
+    def rollback(self):
+        """Points the resource alias back at the newest index older than the live one."""
+        live = self.aliased_indices()
+        older = [name for name in self.versioned_indices()
+                 if name not in live and (not live or name < min(live))]
+        if not older:
+            raise Exception("There is no older index to roll back to.")
+        self.swap_alias(older[-1])
+        return older[-1]
+
+    def drop_index(self, index_name):
+        self.connection.indices.delete(index=index_name, ignore=[400, 404])
+
     def clear(self):
         try:
-            es = Elasticsearch(self.connection)
-            es.indices.delete(
-                index=self.resource_index_name, ignore=[400, 404])
             self.logger.info("Clearing the index.")
-            self.resource_index.delete(ignore=404)
-            ElasticResource.init()
+            self.connection.indices.delete(
+                index='%s*' % self.resource_index_name, ignore=[400, 404])
+            self.ensure_index()
         except:
             self.logger.error(
                 "Failed to delete the indices. They might not exist.")
@@ -75,7 +148,7 @@ class ElasticIndex:
         # update is the same as add, as it will overwrite.  Better to have code in one place.
         self.add_resource(resource, flush)
 
-    def add_resource(self, r, flush=True):
+    def resource_document(self, r):
         er = ElasticResource(
             meta={'id': 'resource_' + str(r.id)},
             id=r.id,
@@ -87,25 +160,118 @@ class ElasticIndex:
             approved=r.approved,
             institution_id=r.institution_id,
             segment_id=r.segment_id,
-            private=r.private)
+            private=r.private,
+            owners=r.owners())
         if r.segment:
             er.segment = r.segment.name
         if r.institution:
             er.institution = r.institution.name
+            er.institution_description = r.institution.description
         if r.type:
             er.type = r.type.name
-        if r.favorites:
-            er.favorite_count = len(r.favorites)
+        er.favorite_count = r.favorite_count
+        return er
 
-        ElasticResource.save(er)
+    def add_resource(self, r, flush=True):
+        ElasticResource.save(self.resource_document(r))
         if flush:
             self.resource_index.flush()
 
-    def load_resources(self, resources):
-        print("Loading resources into %s" % self.index_prefix)
-        for r in resources:
-            self.add_resource(r, flush=False)
-        self.resource_index.flush()
+    def _bulk_action(self, r, index_name):
+        action = self.resource_document(r).to_dict(include_meta=True)
+        action['_index'] = index_name
+        return action
+
+    def _send_batch(self, actions):
+        return helpers.bulk(self.connection, actions, raise_on_error=False,
+                            raise_on_exception=False, stats_only=False)
+
+    def load_resources(self, batches, thread_count=None, index_name=None):
+        """Indexes resources with the bulk API.  Expects an iterable of resource lists, each
+        of which is sent as a single bulk request.  Documents are built on the calling thread
+        (as they read from the database session), while up to thread_count requests are in
+        flight at once.  Prints a line per batch and the overall throughput.  Writes to the
+        live index unless index_name is given."""
+        index_name = index_name or self.resource_index_name
+        print("Loading resources into %s" % index_name)
+        thread_count = thread_count or self.bulk_thread_count
+        started = time.time()
+        indexed = failed = 0
+
+        def report(batch_number, future):
+            success, errors = future.result()
+            print("Batch %i: %i indexed, %i errors" % (batch_number, success, len(errors)))
+            for error in errors:
+                self.logger.error("Failed to index resource: %s" % error)
+            return success, len(errors)
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            pending = []
+            for batch_number, batch in enumerate(batches, start=1):
+                actions = [self._bulk_action(r, index_name) for r in batch]
+                pending.append((batch_number, executor.submit(self._send_batch, actions)))
+                if len(pending) >= thread_count:
+                    success, errors = report(*pending.pop(0))
+                    indexed, failed = indexed + success, failed + errors
+            for batch_number, future in pending:
+                success, errors = report(batch_number, future)
+                indexed, failed = indexed + success, failed + errors
+
+        self.connection.indices.flush(index=index_name)
+        elapsed = max(time.time() - started, 0.001)
+        print("Indexed %i resources in %.2f seconds (%.0f docs/sec), %i errors." %
+              (indexed, elapsed, indexed / elapsed, failed))
+        return indexed, failed
+
+    def indexed_resource_ids(self):
+        """The ids of every resource in the live index, read without fetching sources."""
+        hits = helpers.scan(self.connection, index=self.resource_index_name,
+                            query={'_source': False}, size=self.bulk_chunk_size)
+        return {int(hit['_id'].replace('resource_', '')) for hit in hits}
+
+    def _delete_action(self, id):
+        return {'_op_type': 'delete',
+                '_index': self.resource_index_name,
+                '_type': ElasticResource._doc_type.name,
+                '_id': 'resource_' + str(id)}
+
+    def _failed_ids(self, errors):
+        """Maps the resource id of each failed bulk item to its error.  Deleting a document
+        that is already gone is not a failure."""
+        failed = {}
+        for error in errors:
+            op_type, info = next(iter(error.items()))
+            if op_type == 'delete' and info.get('status') == 404:
+                continue
+            failed[int(info['_id'].replace('resource_', ''))] = \
+                str(info.get('error') or info.get('exception') or info)
+        return failed
+
+    def remove_resources(self, ids):
+        """Deletes the documents for the given resource ids with a single bulk request,
+        returning a dict of resource id to error for any that could not be removed."""
+        actions = [self._delete_action(id) for id in ids]
+        if not actions:
+            return {}
+        success, errors = self._send_batch(actions)
+        failed = self._failed_ids(errors)
+        for id, error in failed.items():
+            self.logger.error("Failed to remove resource %i: %s" % (id, error))
+        self.connection.indices.flush(index=self.resource_index_name)
+        return failed
+
+    def sync_resources(self, resources, removed_ids):
+        """Upserts the given resources and deletes the removed ids in one bulk request,
+        returning a dict of resource id to error for anything that could not be written."""
+        actions = [self._bulk_action(r, self.resource_index_name) for r in resources] + \
+                  [self._delete_action(id) for id in removed_ids]
+        if not actions:
+            return {}
+        success, errors = self._send_batch(actions)
+        failed = self._failed_ids(errors)
+        if success:
+            self.connection.indices.flush(index=self.resource_index_name)
+        return failed
 
     def search_resources(self, search):
         resource_search = ResourceSearch(
@@ -141,12 +307,50 @@ class ElasticResource(DocType):
     institution = Keyword()
     website = Keyword()
     owner = Text()
+    owners = Keyword(multi=True)
     viewable_institution = Keyword(multi=True)
     approved = Keyword()
     favorite_count = Integer()
     institution_id = Integer()
     segment_id = Integer()
     private = Boolean()
+    institution_description = Keyword()
+
+
+def visibility_filter(user):
+    """Builds the Elasticsearch filter that mirrors ThrivResource.user_may_view for the
+    given user (None for anonymous visitors), so search hits never need to be re-checked
+    in Python.  Owners may always see their resources.  Public resources are visible
+    when approved, or to Admins.  Private resources follow the same rule, but only for
+    users whose institution has the same description as the resource's institution."""
+    public = Q('bool', must_not=[Q('term', private=True)])
+    approved = Q('term', approved='Approved')
+
+    if user is None:
+        return Q('bool', must=[public, approved])
+
+    if user.role == 'Admin':
+        approval = Q('match_all')
+    else:
+        approval = approved
+
+    criteria = [Q('bool', must=[public, approval])]
+
+    if user.email is not None:
+        criteria.append(Q('term', owners=user.email))
+
+    if user.institution is not None:
+        description = user.institution.description
+        if description is not None:
+            same_institution = Q('term', institution_description=description)
+        else:
+            same_institution = Q('bool',
+                                 must=[Q('exists', field='institution_id')],
+                                 must_not=[Q('exists', field='institution_description')])
+        criteria.append(
+            Q('bool', must=[Q('term', private=True), same_institution, approval]))
+
+    return Q('bool', should=criteria, minimum_should_match=1)
 
 
 class ResourceSearch(elasticsearch_dsl.FacetedSearch):
@@ -170,51 +374,5 @@ class ResourceSearch(elasticsearch_dsl.FacetedSearch):
         super(ResourceSearch, self).__init__(*args, **kwargs)
 
     def search(self):
-        criteria = []
-
-        if 'user' in g and g.user:
-            if g.user.email is not None:
-                criteria.append(
-                    Q('match', owner=g.user.email)
-                )
-
-            if g.user.role == 'Admin':
-                criteria.append(
-                    Q('term', private=False)
-                )
-
-                if g.user.institution_id is not None:
-                    criteria.append(
-                        Q('bool', must=[
-                            Q('term', private=True),
-                            Q('term', institution_id=g.user.institution_id)
-                        ])
-                    )
-
-            if g.user.role == 'User':
-                criteria.append(
-                    Q('bool', must=[
-                        Q('term', approved='Approved'),
-                        Q('term', private=False)
-                    ])
-                )
-
-                if g.user.institution_id is not None:
-                    criteria.append(
-                        Q('bool', must=[
-                            Q('term', approved='Approved'),
-                            Q('term', private=True),
-                            Q('term', institution_id=g.user.institution_id)
-                        ])
-                    )
-        else:
-            criteria.append(
-                Q('bool', must=[
-                    Q('term', approved='Approved'),
-                    Q('term', private=False)
-                ])
-            )
-
-        s = super(ResourceSearch, self).search().filter(
-            'bool', should=criteria)
-        return s
+        user = g.user if 'user' in g and g.user else None
+        return super(ResourceSearch, self).search().filter(visibility_filter(user))
@@ -1,7 +1,12 @@
+import hashlib
+
 import boto3
+from botocore.exceptions import ClientError
 
 
 class FileServer:
+    """Stores files in S3.  Uploads go through the resource's client, which unlike the
+    resource itself can be shared between threads."""
 
     def __init__(self, app):
         self.s3 = boto3.resource('s3')
@@ -10,18 +15,40 @@ class FileServer:
         self.base_path = app.config['S3']['base_path']
 
     def _save_file(self, data, filename, mime_type):
-        self.s3.Bucket(self.bucket).put_object(Key=filename, Body=data, ACL='public-read',
-                                               ContentType=mime_type)
+        self.s3.meta.client.put_object(Bucket=self.bucket, Key=filename, Body=data,
+                                       ACL='public-read', ContentType=mime_type)
         return self._get_remote_path(filename)
 
+    def _stored_md5(self, key):
+        """The md5 of an object uploaded in one part, which S3 gives as its ETag, or None
+        if there is no such object."""
+        try:
+            response = self.s3.meta.client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError as error:
+            if error.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response['ETag'].strip('"')
+
     def _get_remote_path(self, filename):
         return "{0}/{1}/{2}".format(self.base_url, self.bucket, filename)
 
+    def get_icon_key(self, icon_id, file_extension):
+        return "%s/ithriv/icon/%s.%s" % (self.base_path, icon_id, file_extension)
+
     def save_icon(self, data, icon, file_extension, mime_type):
-        path = "%s/ithriv/icon/%s.%s" % (self.base_path, icon.id, file_extension)
+        path = self.get_icon_key(icon.id, file_extension)
         file_name = self._save_file(data, path, mime_type)
         return file_name
 
+    def sync_icon(self, data, icon_id, file_extension, mime_type):
+        """Uploads the bytes of an icon unless S3 already holds exactly those bytes.
+        Returns the icon's url and whether it was uploaded."""
+        key = self.get_icon_key(icon_id, file_extension)
+        if self._stored_md5(key) == hashlib.md5(data).hexdigest():
+            return self._get_remote_path(key), False
+        return self._save_file(data, key, mime_type), True
+
     def get_key(self, file):
         extension = file.file_name.split('.', 1)[1].lower()
         return "%s/ithriv/resource/attachment/%s.%s" % (self.base_path, file.id, extension)
@@ -0,0 +1,143 @@
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db, RestException
+from app.models import Availability, Category, ResourceCategory, ThrivResource, ThrivType
+from app.resources.schema import ThrivResourceSchema
+
+
+def resource_load_options(relations=None):
+    """Eager loading options that cover everything ThrivResourceSchema touches, so
+    dumping a list of resources costs a fixed number of queries regardless of its size.
+    Many-to-one relations are joined, collections are loaded with one IN query each,
+    and the parent chain of each category is loaded a level at a time.  Pass the names
+    of the relations that will be dumped (see ResourceShape) to load only those."""
+    if relations is None:
+        relations = ResourceShape.RELATIONS
+    category = selectinload(ThrivResource.resource_categories)\
+        .joinedload(ResourceCategory.category)
+    options = {
+        'type': [joinedload(ThrivResource.type).joinedload(ThrivType.icon)],
+        'segment': [joinedload(ThrivResource.segment)],
+        'institution': [joinedload(ThrivResource.institution)],
+        'availabilities': [selectinload(ThrivResource.availabilities)
+                           .joinedload(Availability.institution)],
+        'favorites': [selectinload(ThrivResource.favorites)],
+        'files': [selectinload(ThrivResource.files)],
+        'resource_owners': [selectinload(ThrivResource.resource_owners)],
+        'resource_categories': [category.joinedload(Category.icon),
+                                category.selectinload(Category.parent)
+                                .selectinload(Category.parent)
+                                .selectinload(Category.parent)],
+    }
+    return [option for relation in relations for option in options[relation]]
+
+
+class ResourceShape:
+    """The parts of a resource a client asked for.  ?fields=name,type,... limits the
+    dumped fields (the id is always included), and ?include=type,... names the nested
+    relations to dump, leaving out the others.  Only the relations that will be dumped
+    are loaded.  Without either parameter resources are dumped in full."""
+
+    FIELDS = ThrivResourceSchema.Meta.fields
+    RELATIONS = ('type', 'segment', 'institution', 'availabilities', 'favorites', 'files',
+                 'resource_owners', 'resource_categories')
+    # Fields that read relations other than the one they are named after
+    DEPENDENCIES = {
+        'owners': ['resource_owners'],
+        'user_may_view': ['resource_owners', 'institution'],
+        'user_may_edit': ['resource_owners'],
+    }
+
+    def __init__(self, fields=None, include=None):
+        for name in (fields or []) + (include or []):
+            if name not in self.FIELDS:
+                raise RestException(RestException.INVALID_ARGUMENT,
+                                    details='Unknown resource field "%s"' % name)
+        self.fields = fields
+        self.include = include
+
+    @classmethod
+    def from_request(cls, args):
+        def names(arg):
+            if arg not in args:
+                return None
+            return [name.strip() for name in args[arg].split(',') if name.strip()]
+        return cls(names('fields'), names('include'))
+
+    @property
+    def only(self):
+        """The fields to dump, or None for all of them."""
+        if self.fields is None and self.include is None:
+            return None
+        names = ['id'] + [name for name in (self.fields or self.FIELDS) if name != 'id']
+        if self.include is not None:
+            names = [name for name in names if name not in self.RELATIONS or name in self.include]
+        return tuple(names)
+
+    def relations(self):
+        names = self.only or self.FIELDS
+        relations = set()
+        for name in names:
+            if name in self.RELATIONS:
+                relations.add(name)
+            relations.update(self.DEPENDENCIES.get(name, []))
+        return [relation for relation in self.RELATIONS if relation in relations]
+
+    def load_options(self):
+        return resource_load_options(self.relations())
+
+    def schema(self, many=False):
+        return ThrivResourceSchema(many=many, only=self.only)
+
+    def nest(self, schema, field='resource'):
+        """Applies the shape to a schema's nested resource field."""
+        if self.only is not None:
+            schema.fields[field].only = self.only
+        return schema
+
+    def key(self):
+        return self.only
+
+
+def hydrate_resources(ids, shape=None):
+    """Loads the resources with the given ids, along with their nested relationships
+    (those in the shape, if one is given), returning them in the same order as the ids.
+    Ids with no matching resource are skipped."""
+    ids = [int(i) for i in ids]
+    if not ids:
+        return []
+    options = shape.load_options() if shape is not None else resource_load_options()
+    resources = db.session.query(ThrivResource)\
+        .options(*options)\
+        .filter(ThrivResource.id.in_(ids))\
+        .all()
+    by_id = {r.id: r for r in resources}
+    return [by_id[i] for i in ids if i in by_id]
+
+
+def index_load_options():
+    """Eager loading options for the fields ElasticIndex.resource_document reads."""
+    return [
+        joinedload(ThrivResource.type),
+        joinedload(ThrivResource.segment),
+        joinedload(ThrivResource.institution),
+        selectinload(ThrivResource.resource_owners),
+    ]
+
+
+def resource_batches(batch_size, query=None):
+    """Streams resources out of the database in lists of at most batch_size, paging by
+    id so that each batch is a fresh, bounded query with its relations eager loaded."""
+    if query is None:
+        query = db.session.query(ThrivResource)
+    query = query.options(*index_load_options()).order_by(ThrivResource.id)
+    last_id = None
+    while True:
+        page = query
+        if last_id is not None:
+            page = page.filter(ThrivResource.id > last_id)
+        batch = page.limit(batch_size).all()
+        if not batch:
+            return
+        yield batch
+        last_id = batch[-1].id
@@ -0,0 +1,137 @@
+import datetime
+import logging
+import time
+
+from sqlalchemy import func, or_
+
+from app import app, db, elastic_index
+from app.hydration import index_load_options
+from app.model_events import bump_version
+from app.models import IndexOutbox, ResourceTombstone, ThrivResource
+
+
+def queue_index_update(resource_id):
+    """Records that a resource needs to be (re)indexed.  Must be called before the
+    session is committed, so the outbox entry is saved with the resource change."""
+    db.session.add(IndexOutbox(resource_id=resource_id, operation=IndexOutbox.UPDATE))
+
+
+def queue_institution_index_updates(institution_id):
+    """Records that every resource of an institution needs to be reindexed, as when its
+    description, which their documents carry for the visibility filter, changes."""
+    resource_ids = db.session.query(ThrivResource.id)\
+        .filter(ThrivResource.institution_id == institution_id)
+    for resource_id, in resource_ids:
+        queue_index_update(resource_id)
+
+
+def queue_index_removal(resource_id):
+    """Records that a resource needs to be removed from the index, by the outbox worker
+    and by incremental syncs."""
+    db.session.add(IndexOutbox(resource_id=resource_id, operation=IndexOutbox.DELETE))
+    db.session.add(ResourceTombstone(resource_id=resource_id))
+
+
+class IndexOutboxWorker:
+    """Drains the index outbox into Elasticsearch.  Each entry is applied by looking at
+    the current state of its resource, so repeated changes collapse into a single write
+    and a resource that no longer exists is simply deleted from the index.  Entries that
+    fail are retried with an exponential backoff and dead-lettered after max_attempts."""
+
+    logger = logging.getLogger("IndexOutboxWorker")
+
+    def __init__(self, batch_size=None, max_attempts=None, poll_interval=None):
+        settings = app.config.get('INDEX_OUTBOX', {})
+        self.batch_size = batch_size or settings.get('batch_size', 100)
+        self.max_attempts = max_attempts or settings.get('max_attempts', 8)
+        self.poll_interval = poll_interval or settings.get('poll_interval', 1)
+
+    def process_batch(self):
+        """Applies up to batch_size due entries, returning how many were taken."""
+        now = datetime.datetime.now()
+        entries = db.session.query(IndexOutbox)\
+            .filter(IndexOutbox.dead == False)\
+            .filter(or_(IndexOutbox.next_attempt == None, IndexOutbox.next_attempt <= now))\
+            .order_by(IndexOutbox.id)\
+            .limit(self.batch_size)\
+            .with_for_update(skip_locked=True)\
+            .all()
+        if not entries:
+            db.session.commit()
+            return 0
+
+        ids = {e.resource_id for e in entries}
+        resources = db.session.query(ThrivResource)\
+            .options(*index_load_options())\
+            .filter(ThrivResource.id.in_(ids))\
+            .all()
+        removed = ids - {r.id for r in resources}
+        try:
+            failed = elastic_index.sync_resources(resources, removed)
+        except Exception as e:
+            failed = {id: str(e) for id in ids}
+
+        for entry in entries:
+            if entry.resource_id not in failed:
+                db.session.delete(entry)
+                continue
+            entry.attempts += 1
+            entry.last_error = failed[entry.resource_id][:2000]
+            if entry.attempts >= self.max_attempts:
+                entry.dead = True
+                self.logger.error("Giving up on indexing resource %i: %s" %
+                                  (entry.resource_id, entry.last_error))
+            else:
+                entry.next_attempt = now + datetime.timedelta(
+                    seconds=min(2 ** entry.attempts, 300))
+        if len(failed) < len(ids):
+            # Moves cached searches in every process on to the updated index
+            bump_version(db.session, 'search_index')
+        db.session.commit()
+
+        if failed:
+            self.logger.warning("%i of %i index changes failed and will be retried." %
+                                (len(failed), len(ids)))
+        return len(entries)
+
+    def drain(self):
+        """Processes entries until nothing is due, returning the number processed."""
+        total = 0
+        while True:
+            processed = self.process_batch()
+            if not processed:
+                return total
+            total += processed
+
+    def status(self):
+        """Pending and dead-lettered entry counts, and the lag in seconds between now
+        and the oldest pending change."""
+        pending, oldest = db.session.query(func.count(IndexOutbox.id), func.min(IndexOutbox.created))\
+            .filter(IndexOutbox.dead == False).one()
+        dead = db.session.query(func.count(IndexOutbox.id))\
+            .filter(IndexOutbox.dead == True).scalar()
+        lag = (datetime.datetime.now() - oldest).total_seconds() if oldest else 0.0
+        return {'pending': pending, 'dead': dead, 'lag_seconds': lag}
+
+    def requeue_dead(self):
+        """Gives dead-lettered entries another full set of attempts."""
+        count = db.session.query(IndexOutbox)\
+            .filter(IndexOutbox.dead == True)\
+            .update({'dead': False, 'attempts': 0, 'next_attempt': datetime.datetime.now()},
+                    synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def run(self):
+        print("Index outbox worker started, polling every %s seconds." % self.poll_interval)
+        while True:
+            try:
+                processed = self.drain()
+                if processed:
+                    status = self.status()
+                    print("Applied %i index changes. %i pending, %i dead, lag %.1f seconds." %
+                          (processed, status['pending'], status['dead'], status['lag_seconds']))
+            except Exception as e:
+                db.session.rollback()
+                self.logger.error("Index outbox worker failed: %s" % e)
+            time.sleep(self.poll_interval)
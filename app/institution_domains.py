@@ -0,0 +1,56 @@
+import threading
+import time
+
+from app import db
+from app.model_events import on_commit
+from app.models import ThrivInstitution
+
+
+class InstitutionDomains:
+    """Maps email domains to institutions, so that users can be linked to their
+    institution at login without reading every institution.  A domain matches itself and
+    any subdomain of it, and the most specific domain wins.  The map is rebuilt after
+    institutions change in this process, and at least every ttl seconds to pick up
+    changes made elsewhere."""
+
+    ttl = 300
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._domains = None
+        self._expires = 0
+
+    def _build(self):
+        domains = {}
+        for id, domain in db.session.query(ThrivInstitution.id, ThrivInstitution.domain)\
+                .filter(ThrivInstitution.domain != None)\
+                .order_by(ThrivInstitution.id):
+            domain = domain.strip().lstrip('@.').lower()
+            if domain:
+                domains.setdefault(domain, id)
+        return domains
+
+    def domains(self):
+        with self._lock:
+            if self._domains is None or self._expires < time.time():
+                self._domains = self._build()
+                self._expires = time.time() + self.ttl
+            return self._domains
+
+    def match(self, address):
+        """The id of the institution for an eppn or email address, or None."""
+        domains = self.domains()
+        labels = address.lower().rsplit('@', 1)[-1].split('.')
+        for i in range(len(labels)):
+            id = domains.get('.'.join(labels[i:]))
+            if id is not None:
+                return id
+        return None
+
+    def invalidate(self):
+        with self._lock:
+            self._domains = None
+
+
+institution_domains = InstitutionDomains()
+on_commit([ThrivInstitution], institution_domains.invalidate)
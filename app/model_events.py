@@ -0,0 +1,120 @@
+import datetime
+import itertools
+
+from sqlalchemy import event, inspect
+from sqlalchemy.dialects.postgresql import insert
+
+from app import db
+
+ALL_ATTRIBUTES = '*'
+
+_commit_listeners = []
+_version_counters = []
+
+
+def on_commit(models, callback):
+    """Calls callback() after any transaction that inserted, updated or deleted instances
+    of the given model classes has been committed.  Bulk query deletes and updates are
+    included.  Callbacks run in the process that made the change."""
+    _commit_listeners.append((tuple(models), callback))
+
+
+def track_version(name, models, attributes=None):
+    """Keeps a counter in the data_version table that is incremented, within the same
+    transaction, whenever instances of the given models are inserted or deleted, or have
+    any of the given attributes changed (any attribute if None).  Unlike on_commit this is
+    visible to every process, so caches can cheaply check whether they are stale.  The time
+    of the last change is kept with the counter."""
+    _version_counters.append((name, tuple(models), set(attributes) if attributes else None))
+
+
+def current_version(name):
+    from app.models import DataVersion
+    version = db.session.query(DataVersion.version).filter(DataVersion.name == name).scalar()
+    return version or 0
+
+
+def _matches(changed, models, attributes=None):
+    for cls, changed_attributes in changed.items():
+        if not isinstance(cls, type) or not issubclass(cls, models):
+            continue
+        if attributes is None or ALL_ATTRIBUTES in changed_attributes \
+                or attributes & changed_attributes:
+            return True
+    return False
+
+
+def bump_version(session, name):
+    """Increments the named data version within the session's transaction, for changes
+    made outside the database, such as to the search index, that caches depend on."""
+    from app.models import DataVersion
+    table = DataVersion.__table__
+    now = datetime.datetime.utcnow()
+    session.execute(
+        insert(table).values(name=name, version=1, last_updated=now).on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={'version': table.c.version + 1, 'last_updated': now}))
+
+
+def _bump_versions(session, changed):
+    for name, models, attributes in _version_counters:
+        if _matches(changed, models, attributes):
+            bump_version(session, name)
+
+
+def _changed_models(session):
+    return session.info.setdefault('changed_models', {})
+
+
+def record_changes(session, models):
+    """Records that instances of the given models were written without going through the
+    ORM (with COPY, say), so that versions move on and on_commit callbacks run just as they
+    would after a flush."""
+    changed = {cls: {ALL_ATTRIBUTES} for cls in models}
+    for cls, attributes in changed.items():
+        _changed_models(session).setdefault(cls, set()).update(attributes)
+    _bump_versions(session, changed)
+
+
+def _record_bulk(context):
+    record_changes(context.session,
+                   [description['type'] for description in context.query.column_descriptions])
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_flush(session, flush_context):
+    changed = {}
+    for obj in itertools.chain(session.new, session.deleted):
+        changed.setdefault(type(obj), set()).add(ALL_ATTRIBUTES)
+    for obj in session.dirty:
+        state = inspect(obj)
+        changed.setdefault(type(obj), set()).update(
+            attr.key for attr in state.attrs if attr.history.has_changes())
+    for cls, attributes in changed.items():
+        _changed_models(session).setdefault(cls, set()).update(attributes)
+    _bump_versions(session, changed)
+
+
+@event.listens_for(db.session, 'after_bulk_delete')
+def _record_bulk_delete(context):
+    _record_bulk(context)
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+def _record_bulk_update(context):
+    _record_bulk(context)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _notify_commit(session):
+    changed = session.info.pop('changed_models', {})
+    if not changed:
+        return
+    for models, callback in _commit_listeners:
+        if _matches(changed, models):
+            callback()
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('changed_models', None)
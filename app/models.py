@@ -1,12 +1,17 @@
 import datetime
+import itertools
 import re
+from collections import Counter
 
 import jwt
 from flask import g
+from sqlalchemy import and_, event, false, func, inspect, or_, select, true
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import joinedload, noload
+from sqlalchemy.orm.attributes import set_committed_value
 
-from app import RestException, app, bcrypt, db
+from app import RestException, app, db, password_hasher
 
 Base = declarative_base()
 
@@ -33,9 +38,25 @@ class Category(db.Model):
                                order_by="Category.display_order, Category.name")
     icon_id = db.Column(db.Integer, db.ForeignKey('icon.id'))
     icon = db.relationship("Icon")
+    # Materialized path of ids from the root down to this category, ie "/1/5/12/".  It is
+    # maintained by rebuild_category_paths whenever categories are added or moved.
+    path = db.Column(db.String)
+    __table_args__ = (db.Index('ix_category_path_pattern', 'path',
+                               postgresql_ops={'path': 'text_pattern_ops'}),)
+
+    def ancestor_ids(self):
+        """Ids from the root down to and including this category, read from the path."""
+        if not self.path:
+            return None
+        return [int(id) for id in self.path.strip('/').split('/')]
 
     def calculate_color(self):
         """Color is inherited from the parent category if not set explicitly."""
+        ids = self.ancestor_ids()
+        if ids is not None:
+            if self.color or len(ids) == 1:
+                return self.color
+            return db.session.query(Category).get(ids[0]).color
         color = self.color
         cat = self.parent
         while not self.color and cat:
@@ -45,6 +66,9 @@ class Category(db.Model):
 
     def calculate_level(self):
         """Provide the depth of the category """
+        ids = self.ancestor_ids()
+        if ids is not None:
+            return len(ids) - 1
         level = 0
         cat = self
         while cat.parent:
@@ -52,6 +76,95 @@ class Category(db.Model):
             cat = cat.parent
         return level
 
+    def ancestors(self):
+        """All the categories above this one, starting from the root."""
+        ids = self.ancestor_ids() or []
+        ancestors = db.session.query(Category).filter(Category.id.in_(ids[:-1])).all()
+        return sorted(ancestors, key=lambda c: ids.index(c.id))
+
+    def subtree_query(self):
+        """A query for this category and all of its descendants."""
+        return db.session.query(Category).filter(Category.path.like(self.path + '%'))
+
+    def subtree_resources_query(self):
+        """A query for the resources in this category or any of its descendants."""
+        return db.session.query(ThrivResource)\
+            .filter(ThrivResource.id.in_(
+                db.session.query(ResourceCategory.resource_id)
+                .join(ResourceCategory.category)
+                .filter(Category.path.like(self.path + '%'))))
+
+    @staticmethod
+    def load_tree(root=None):
+        """Loads every category (or the given category and its descendants) with a single
+        query, and wires up their children so the whole tree can be walked and serialized
+        without further queries, however deep it is.  Returns the top of the tree."""
+        query = db.session.query(Category)\
+            .options(noload(Category.children), joinedload(Category.icon))\
+            .order_by(Category.display_order, Category.name)
+        if root is not None:
+            query = query.filter(Category.path.like(root.path + '%'))
+        categories = query.all()
+        children = {c.id: [] for c in categories}
+        for c in categories:
+            if c.parent_id in children:
+                children[c.parent_id].append(c)
+        for c in categories:
+            set_committed_value(c, 'children', children[c.id])
+        if root is not None:
+            return [c for c in categories if c.id == root.id]
+        return [c for c in categories if c.parent_id is None]
+
+
+CATEGORY_PATH_SQL = """
+    WITH RECURSIVE tree(id, path) AS (
+        SELECT id, '/' || id || '/' FROM category WHERE parent_id IS NULL
+        UNION ALL
+        SELECT c.id, tree.path || c.id || '/' FROM category c JOIN tree ON c.parent_id = tree.id
+    )
+    UPDATE category SET path = tree.path FROM tree
+    WHERE category.id = tree.id AND category.path IS DISTINCT FROM tree.path
+"""
+
+
+def rebuild_category_paths(session):
+    """Recomputes the materialized path of every category in a single statement."""
+    session.execute(CATEGORY_PATH_SQL)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _update_category_paths(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Category):
+            break
+    else:
+        for obj in session.dirty:
+            if isinstance(obj, Category) and session.is_modified(obj) and \
+                    any(db.inspect(obj).attrs[key].history.has_changes()
+                        for key in ('parent_id', 'parent')):
+                break
+        else:
+            return
+    rebuild_category_paths(session)
+    session.info['category_paths_changed'] = True
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _expire_category_paths(session, flush_context):
+    if session.info.pop('category_paths_changed', False):
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, Category):
+                session.expire(obj, ['path'])
+
+
+class DataVersion(db.Model):
+    """A counter that is incremented whenever the data it tracks changes, see
+    app.model_events.track_version."""
+    __tablename__ = 'data_version'
+    name = db.Column(db.String, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    last_updated = db.Column(db.DateTime)
+
 
 class EmailLog(db.Model):
     __tablename__ = 'email_log'
@@ -63,6 +176,40 @@ class EmailLog(db.Model):
     date_viewed = db.Column(db.DateTime)
 
 
+class IndexSync(db.Model):
+    """Records when a search index was last brought up to date with the database, so
+    incremental syncs only need to look at resources changed since then."""
+    __tablename__ = 'index_sync'
+    id = db.Column(db.Integer, primary_key=True)
+    index_name = db.Column(db.String, nullable=False, unique=True)
+    synced_at = db.Column(db.DateTime)
+
+
+class ResourceTombstone(db.Model):
+    """Records that a resource was deleted, so incremental index syncs can remove it from
+    the index without comparing the whole index with the database."""
+    __tablename__ = 'resource_tombstone'
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.DateTime, default=datetime.datetime.now, nullable=False, index=True)
+
+
+class IndexOutbox(db.Model):
+    """A pending change to the search index, written in the same transaction as the
+    change to the resource and applied later by the IndexOutboxWorker."""
+    __tablename__ = 'index_outbox'
+    UPDATE = 'update'
+    DELETE = 'delete'
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(db.Integer, nullable=False, index=True)
+    operation = db.Column(db.String, nullable=False)
+    created = db.Column(db.DateTime, default=datetime.datetime.now)
+    next_attempt = db.Column(db.DateTime, default=datetime.datetime.now)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.String)
+    dead = db.Column(db.Boolean, default=False, nullable=False)
+
+
 class Favorite(db.Model):
     __tablename__ = 'favorite'
     id = db.Column(db.Integer, primary_key=True)
@@ -75,6 +222,19 @@ class Favorite(db.Model):
         'user_id', db.Integer, db.ForeignKey('ithriv_user.id'), nullable=False)
 
 
+class ResourceOwner(db.Model):
+    '''One of the email addresses listed in a resource's owner field.'''
+    __tablename__ = 'resource_owner'
+    id = db.Column(db.Integer, primary_key=True)
+    resource_id = db.Column(
+        'resource_id',
+        db.Integer,
+        db.ForeignKey('resource.id'),
+        nullable=False,
+        index=True)
+    email = db.Column(db.String, nullable=False, index=True)
+
+
 class Icon(db.Model):
     __tablename__ = 'icon'
     id = db.Column(db.Integer, primary_key=True)
@@ -130,6 +290,12 @@ class ThrivResource(db.Model):
         lambda: Favorite,
         cascade="all, delete-orphan",
         backref=db.backref('resource', lazy=True))
+    # The addresses in owner, kept in step with it by _update_resource_owners
+    resource_owners = db.relationship(
+        lambda: ResourceOwner,
+        cascade="all, delete-orphan",
+        order_by=lambda: ResourceOwner.id,
+        backref=db.backref('resource', lazy=True))
     files = db.relationship("UploadedFile", back_populates="resource")
     categories = db.relationship("ResourceCategory", back_populates="resource")
     approved = db.Column(db.String)
@@ -139,15 +305,34 @@ class ThrivResource(db.Model):
     location = db.Column(db.String)
     starts = db.Column(db.DateTime)
     ends = db.Column(db.DateTime)
-
-    def favorite_count(self):
-        return len(self.favorites)
+    # Number of favorites, kept up to date by adjust_favorite_counts so that resources can
+    # be sorted by popularity in the database.
+    favorite_count = db.Column(db.Integer, default=0, server_default='0', nullable=False,
+                               index=True)
+    # Incremented whenever the resource, or a row of its own that it is shown with, changes.
+    # See bump_resource_versions.
+    version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Support the keyset paging of ResourceListEndpoint
+    __table_args__ = (
+        db.Index('ix_resource_segment_last_updated', 'segment_id', 'last_updated', 'id'),
+        db.Index('ix_resource_last_updated', 'last_updated', 'id'),
+        db.Index('ix_resource_segment_starts', 'segment_id', 'starts', 'id'),
+        db.Index('ix_resource_ends', 'ends'),
+    )
 
     def owners(self):
-        try:
-            return re.split('; |, | ', self.owner)
-        except Exception:
+        return [o.email for o in self.resource_owners]
+
+    @staticmethod
+    def split_owners(owner):
+        """The distinct email addresses in an owner field."""
+        if not owner:
             return []
+        emails = []
+        for email in re.split('; |, | ', owner):
+            if email and email not in emails:
+                emails.append(email)
+        return emails
 
     def user_may_view(self):
         try:
@@ -208,6 +393,123 @@ class ThrivResource(db.Model):
         except Exception:
             return False
 
+    @classmethod
+    def owned_by(cls, email):
+        """A filter expression matching the resources that list the email among their owners."""
+        return cls.resource_owners.any(ResourceOwner.email == email)
+
+    @classmethod
+    def viewable_by(cls, user):
+        """A filter expression matching the resources that user_may_view allows the given
+        user (None when anonymous) to see, so that the check can be made in the database."""
+        public = or_(cls.private == None, cls.private == False)
+        approved = cls.approved == 'Approved'
+        if user is None:
+            return and_(public, approved)
+        if user.role == "Admin":
+            approved = true()
+        conditions = [and_(public, approved)]
+        if user.email:
+            conditions.append(cls.owned_by(user.email))
+        institution = user.institution
+        if institution is not None:
+            conditions.append(and_(
+                cls.institution.has(ThrivInstitution.description == institution.description),
+                approved))
+        return or_(*conditions)
+
+    @classmethod
+    def editable_by(cls, user):
+        """A filter expression matching the resources that user_may_edit allows the given
+        user to change."""
+        if user is None:
+            return false()
+        conditions = []
+        if user.email:
+            conditions.append(cls.owned_by(user.email))
+        if user.role == "Admin":
+            conditions.append(or_(cls.private == None, cls.private == False,
+                                  cls.institution_id == user.institution_id))
+        return or_(*conditions) if conditions else false()
+
+
+@event.listens_for(db.session, 'after_flush')
+def _record_deleted_resources(session, flush_context):
+    """Leaves a tombstone for each resource deleted through the session.  Resources
+    deleted with a bulk query are recorded by app.index_outbox.queue_index_removal."""
+    now = datetime.datetime.now()
+    rows = [{'resource_id': obj.id, 'deleted': now}
+            for obj in session.deleted if isinstance(obj, ThrivResource)]
+    if rows:
+        session.execute(ResourceTombstone.__table__.insert(), rows)
+
+
+@event.listens_for(ThrivResource.owner, 'set')
+def _update_resource_owners(resource, owner, old_owner, initiator):
+    """Rewrites the resource_owners of a resource whenever its owner field is set."""
+    existing = {o.email: o for o in resource.resource_owners}
+    resource.resource_owners = [existing.get(email) or ResourceOwner(email=email)
+                                for email in ThrivResource.split_owners(owner)]
+
+
+def update_favorite_counts(session, resource_ids=None):
+    """Recounts the favorites of the given resources (or of every resource if None)
+    with a single UPDATE.  The count comes from the transaction's snapshot, so this is
+    for loading and repairing counts; writes that race with other transactions should
+    use adjust_favorite_counts."""
+    resource = ThrivResource.__table__
+    count = select([func.count(Favorite.id)])\
+        .where(Favorite.resource_id == resource.c.id)\
+        .as_scalar()
+    update = resource.update().values(favorite_count=count)
+    if resource_ids is not None:
+        resource_ids = {id for id in resource_ids if id is not None}
+        if not resource_ids:
+            return
+        update = update.where(resource.c.id.in_(resource_ids))
+    session.execute(update)
+
+
+def adjust_favorite_counts(session, changes):
+    """Adds each change, a dict of amounts by resource id, to the resources'
+    favorite_count.  The addition is made to the row as it is when the UPDATE gets its
+    lock, so concurrent transactions favoriting the same resource don't lose each
+    other's changes.  Returns the ids of the resources changed."""
+    resource = ThrivResource.__table__
+    by_amount = {}
+    for resource_id, amount in changes.items():
+        if resource_id is not None and amount:
+            by_amount.setdefault(amount, []).append(resource_id)
+    for amount, resource_ids in by_amount.items():
+        session.execute(resource.update()
+                        .where(resource.c.id.in_(sorted(resource_ids)))
+                        .values(favorite_count=resource.c.favorite_count + amount))
+    return {id for ids in by_amount.values() for id in ids}
+
+
+@event.listens_for(db.session, 'before_flush')
+def _find_removed_favorites(session, flush_context, instances):
+    session.info['removed_favorites'] = \
+        Counter(obj.resource_id for obj in session.deleted if isinstance(obj, Favorite))
+
+
+@event.listens_for(db.session, 'after_flush')
+def _update_favorite_counts(session, flush_context):
+    changes = Counter(obj.resource_id for obj in session.new if isinstance(obj, Favorite))
+    changes.subtract(session.info.pop('removed_favorites', Counter()))
+    ids = adjust_favorite_counts(session, changes)
+    if ids:
+        session.info['favorite_counts_changed'] = ids
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _expire_favorite_counts(session, flush_context):
+    ids = session.info.pop('favorite_counts_changed', None)
+    if ids:
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, ThrivResource) and obj.id in ids:
+                session.expire(obj, ['favorite_count'])
+
 
 class ResourceCategory(db.Model):
     __tablename__ = 'resource_category'
@@ -253,6 +555,46 @@ class UploadedFile(db.Model):
     resource = db.relationship(ThrivResource)
 
 
+# The rows that belong to a single resource and are shown with it
+RESOURCE_PARTS = (ResourceOwner, Availability, ResourceCategory, UploadedFile, Favorite)
+
+
+def bump_resource_versions(session, resource_ids=None):
+    """Increments the version of the given resources (or of every resource if None) with
+    a single UPDATE, which the validators of /api/resource/<id> are made from.  The
+    increment is made to the row as it is when the UPDATE gets its lock, so concurrent
+    changes are all counted.  Lookup tables a resource is shown with, such as its type,
+    have data versions of their own."""
+    resource = ThrivResource.__table__
+    update = resource.update().values(version=resource.c.version + 1)
+    if resource_ids is not None:
+        if not resource_ids:
+            return
+        update = update.where(resource.c.id.in_(sorted(resource_ids)))
+    session.execute(update)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _bump_changed_resource_versions(session, flush_context):
+    ids = {obj.id for obj in session.dirty
+           if isinstance(obj, ThrivResource) and session.is_modified(obj, include_collections=False)}
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, RESOURCE_PARTS):
+            ids.update(id for id in inspect(obj).attrs.resource_id.history.sum() if id is not None)
+    if ids:
+        bump_resource_versions(session, ids)
+        session.info['resource_versions_changed'] = ids
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def _expire_resource_versions(session, flush_context):
+    ids = session.info.pop('resource_versions_changed', None)
+    if ids:
+        for obj in list(session.identity_map.values()):
+            if isinstance(obj, ThrivResource) and obj.id in ids:
+                session.expire(obj, ['version'])
+
+
 class User(db.Model):
     __tablename__ = 'ithriv_user'
     id = db.Column(db.Integer, primary_key=True)
@@ -274,12 +616,15 @@ class User(db.Model):
 
     @password.setter
     def password(self, plaintext):
-        self._password = bcrypt.generate_password_hash(plaintext)
+        self._password = password_hasher.hash(plaintext)
 
     def is_correct_password(self, plaintext):
         if not self._password:
             raise RestException(RestException.LOGIN_FAILURE)
-        return bcrypt.check_password_hash(self._password, plaintext)
+        return password_hasher.check(self._password, plaintext)
+
+    def password_needs_rehash(self):
+        return self._password is not None and password_hasher.needs_rehash(self._password)
 
     def encode_auth_token(self):
         try:
@@ -303,6 +648,59 @@ class User(db.Model):
             raise RestException(RestException.TOKEN_INVALID)
 
 
+# What a cached principal holds of a user and of their institution, see app.principal_cache
+PRINCIPAL_ATTRIBUTES = ('email', 'role', 'institution_id', 'institution')
+PRINCIPAL_INSTITUTION_ATTRIBUTES = ('description',)
+
+
+def _changed(obj, attributes):
+    state = inspect(obj)
+    return any(state.attrs[key].history.has_changes() for key in attributes)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _find_changed_principals(session, flush_context):
+    """Notes the users whose cached principals a flush makes stale, by their id or that of
+    their institution, so they can be evicted once the change is committed."""
+    users, institutions = session.info.setdefault('changed_principals', (set(), set()))
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            users.add(obj.id)
+        elif isinstance(obj, ThrivInstitution):
+            institutions.add(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, User) and _changed(obj, PRINCIPAL_ATTRIBUTES):
+            users.add(obj.id)
+        elif isinstance(obj, ThrivInstitution) and \
+                _changed(obj, PRINCIPAL_INSTITUTION_ATTRIBUTES):
+            institutions.add(obj.id)
+
+
+@event.listens_for(db.session, 'after_bulk_update')
+@event.listens_for(db.session, 'after_bulk_delete')
+def _find_bulk_changed_principals(context):
+    """Bulk queries don't say which rows they changed, so every principal is made stale."""
+    models = [description['type'] for description in context.query.column_descriptions]
+    if any(model in (User, ThrivInstitution) for model in models):
+        context.session.info['all_principals_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def _evict_changed_principals(session):
+    from app import principal_cache
+    users, institutions = session.info.pop('changed_principals', (None, None))
+    if session.info.pop('all_principals_changed', False):
+        principal_cache.invalidate()
+    elif users or institutions:
+        principal_cache.evict(users, institutions)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_changed_principals(session):
+    session.info.pop('changed_principals', None)
+    session.info.pop('all_principals_changed', None)
+
+
 class Search():
     query = ""
     filters = []
@@ -350,3 +748,19 @@ class Filter():
     def __init__(self, field, value):
         self.field = field
         self.value = value
+
+
+from app.model_events import track_version
+
+# The category tree includes approved resource counts, so it changes with approvals too.
+track_version('category_tree', [Category, ResourceCategory, Icon])
+track_version('category_tree', [ThrivResource], attributes=['approved'])
+track_version('institution', [ThrivInstitution])
+track_version('type', [ThrivType, Icon])
+track_version('segment', [ThrivSegment])
+track_version('icon', [Icon])
+track_version('category', [Category, Icon])
+# Everything a dumped resource includes but its favorites, which reach cached searches
+# through the index
+track_version('resource', [ThrivResource, ResourceOwner, ResourceCategory, Category, Availability,
+                           UploadedFile, ThrivType, ThrivSegment, ThrivInstitution, Icon])
@@ -0,0 +1,88 @@
+import base64
+import datetime
+import json
+from urllib.parse import urlencode
+
+from flask import request
+from sqlalchemy import and_, false, or_
+
+from app import RestException
+
+
+class ResourcePage:
+    """Keyset pagination over resources.  Results are ordered by a list of sort keys, given
+    as (expression, descending) pairs on ThrivResource that end with a unique column, and a
+    page is addressed by an opaque token holding the sort key values of the last resource
+    on the page before it (?after=<token>, as given in the Link header).  Unlike an offset,
+    this costs the same however deep the page is and does not skip or repeat rows when
+    other resources are added or removed between requests.  Nor does the next page move
+    if that last resource is changed or removed, as the token doesn't look it up again."""
+
+    def __init__(self, keys, default_limit=20, max_limit=100):
+        self.keys = keys
+        args = request.args
+        try:
+            self.limit = min(max(int(args.get('limit', default_limit)), 1), max_limit)
+        except ValueError:
+            raise RestException(RestException.INVALID_ARGUMENT,
+                                details='limit must be an integer')
+        self.after = self._decode(args['after']) if 'after' in args else None
+
+    def apply(self, query):
+        """Orders and limits the query to this page."""
+        if self.after is not None:
+            query = query.filter(self._following(self.after))
+        return query\
+            .order_by(*[key.desc() if descending else key for key, descending in self.keys])\
+            .limit(self.limit)
+
+    def headers(self, items, last, total=None):
+        """The Link header to the next page (when this one is full, and last is the resource
+        it ends with) and the total count."""
+        headers = {}
+        if total is not None:
+            headers['X-Total-Count'] = str(total)
+        if len(items) == self.limit:
+            args = dict(request.args.items(), limit=self.limit, after=self._encode(last))
+            headers['Link'] = '<%s?%s>; rel="next"' % (request.base_url, urlencode(args))
+        return headers
+
+    def _encode(self, resource):
+        values = [getattr(resource, key.key) for key, descending in self.keys]
+        data = json.dumps([v.isoformat() if isinstance(v, datetime.datetime) else v
+                           for v in values], separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def _decode(self, token):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+            if not isinstance(values, list) or len(values) != len(self.keys):
+                raise ValueError(token)
+            return [None if value is None else self._parse(key, value)
+                    for (key, descending), value in zip(self.keys, values)]
+        except (ValueError, TypeError):
+            raise RestException(RestException.INVALID_ARGUMENT,
+                                details='after must be a token from a Link header')
+
+    @staticmethod
+    def _parse(key, value):
+        python_type = key.type.python_type
+        if python_type is datetime.datetime:
+            return datetime.datetime.fromisoformat(value)
+        if not isinstance(value, python_type) or isinstance(value, bool) != (python_type is bool):
+            raise ValueError(value)
+        return value
+
+    def _following(self, values):
+        """Matches the rows that sort after the given key values, ie (a > a1) or
+        (a = a1 and b > b1) or ...  Nulls sort as the largest value, as in Postgres."""
+        conditions = []
+        for i, (key, descending) in enumerate(self.keys):
+            value = values[i]
+            if descending:
+                following = key != None if value is None else key < value
+            else:
+                following = false() if value is None else or_(key > value, key == None)
+            equal = [k == v for (k, d), v in zip(self.keys[:i], values[:i])]
+            conditions.append(and_(*equal, following))
+        return or_(*conditions)
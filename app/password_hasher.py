@@ -0,0 +1,88 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from app.rest_exception import RestException
+
+
+class PasswordHasher:
+    """Runs bcrypt on a small pool of threads rather than on whichever request happens to
+    need it, so that a burst of logins or password resets can only take up a bounded
+    amount of CPU.  Once every worker is busy and max_pending calls are waiting, further
+    calls are rejected straight away with a 503 instead of queueing behind them.
+
+    The work factor is Flask-Bcrypt's BCRYPT_LOG_ROUNDS; hashes made with a different
+    one are reported by needs_rehash so they can be upgraded when a user logs in."""
+
+    logger = logging.getLogger("PasswordHasher")
+
+    def __init__(self, app, bcrypt):
+        settings = app.config.get('PASSWORD_HASHING', {})
+        self.bcrypt = bcrypt
+        self.workers = settings.get('workers', 2)
+        self.max_pending = settings.get('max_pending', 8)
+        self.timeout = settings.get('timeout', 10)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        self._slots = threading.BoundedSemaphore(self.workers + self.max_pending)
+        self._lock = threading.Lock()
+        self._timings = {'hash': [0, 0.0, 0.0], 'check': [0, 0.0, 0.0]}
+        self.rejected = 0
+
+    def hash(self, plaintext):
+        return self._run('hash', self.bcrypt.generate_password_hash, plaintext)
+
+    def check(self, hashed, plaintext):
+        return self._run('check', self.bcrypt.check_password_hash, hashed, plaintext)
+
+    def needs_rehash(self, hashed):
+        """True if the hash was made with a work factor other than the configured one."""
+        if isinstance(hashed, str):
+            hashed = hashed.encode('utf-8')
+        try:
+            rounds = int(hashed.split(b'$')[2])
+        except (IndexError, ValueError):
+            return True
+        return rounds != self.bcrypt._log_rounds
+
+    def _run(self, operation, function, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            self.logger.warning("Rejected a password %s, all %i slots are in use." %
+                                (operation, self.workers + self.max_pending))
+            raise RestException(RestException.SERVER_BUSY)
+        try:
+            future = self._executor.submit(self._timed, operation, function, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            self.logger.warning("Password %s took more than %i seconds." %
+                                (operation, self.timeout))
+            raise RestException(RestException.SERVER_BUSY)
+
+    def _timed(self, operation, function, *args):
+        started = time.time()
+        try:
+            return function(*args)
+        finally:
+            self._slots.release()
+            elapsed = time.time() - started
+            with self._lock:
+                timing = self._timings[operation]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    def stats(self):
+        """Call counts with the mean and maximum time bcrypt took, in seconds."""
+        with self._lock:
+            stats = {operation: {'count': count,
+                                 'mean_seconds': total / count if count else 0.0,
+                                 'max_seconds': longest}
+                     for operation, (count, total, longest) in self._timings.items()}
+            stats['rejected'] = self.rejected
+        return stats
@@ -0,0 +1,105 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+PrincipalInstitution = namedtuple('PrincipalInstitution', ['id', 'description'])
+
+
+class Principal:
+    """The parts of a User that authentication and the visibility rules need, so that
+    authenticated requests can be served without reading the user from the database.
+    Any other attribute is read from the User row, which is loaded the first time one
+    is asked for."""
+
+    def __init__(self, id, email, role, institution_id, institution):
+        self.id = id
+        self.email = email
+        self.role = role
+        self.institution_id = institution_id
+        self.institution = institution
+        self._user = None
+
+    @classmethod
+    def from_user(cls, user):
+        institution = None
+        if user.institution is not None:
+            institution = PrincipalInstitution(user.institution.id, user.institution.description)
+        return cls(user.id, user.email, user.role, user.institution_id, institution)
+
+    def load(self):
+        """The User this principal stands for."""
+        if self._user is None:
+            from app import db
+            from app.models import User
+            self._user = db.session.query(User).get(self.id)
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+
+class PrincipalCache:
+    """An in-process LRU cache of principals by user id, whose entries also expire after a
+    time to live.  A hit doesn't touch the database.  When a user's email, role or
+    institution, or their institution's description, changes, or the user is deleted,
+    the process that commits the change evicts them at once (see the listeners in
+    app.models).  Other processes keep using their entry until it expires, so ttl is the
+    longest a demoted or deleted user can keep their old role anywhere."""
+
+    def __init__(self, app):
+        settings = app.config.get('PRINCIPAL_CACHE', {})
+        self.max_size = settings.get('max_size', 4096)
+        self.ttl = settings.get('ttl', 30)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """A new Principal for the user, or None if there is no such user."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[0] >= time.time():
+                self._entries.move_to_end(user_id)
+                return Principal(*entry[1])
+        principal = self._load(user_id)
+        if principal is not None and self.max_size > 0:
+            with self._lock:
+                self._entries[user_id] = (time.time() + self.ttl,
+                                          (principal.id, principal.email, principal.role,
+                                           principal.institution_id, principal.institution))
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return principal
+
+    @staticmethod
+    def _load(user_id):
+        from sqlalchemy.orm import joinedload
+        from app import db
+        from app.models import User
+        user = db.session.query(User)\
+            .options(joinedload(User.institution))\
+            .filter(User.id == user_id)\
+            .first()
+        if user is None:
+            return None
+        principal = Principal.from_user(user)
+        principal._user = user
+        return principal
+
+    def evict(self, user_ids=(), institution_ids=()):
+        """Forgets the given users, and everyone at the given institutions."""
+        user_ids, institution_ids = set(user_ids or ()), set(institution_ids or ())
+        with self._lock:
+            for user_id, (_, data) in list(self._entries.items()):
+                if user_id in user_ids or data[3] in institution_ids:
+                    del self._entries[user_id]
+
+    def invalidate(self, user_id=None):
+        """Forgets the given user, or everyone if no user is given."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
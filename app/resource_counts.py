@@ -0,0 +1,71 @@
+from collections import defaultdict
+
+from flask import g, has_request_context, request
+from sqlalchemy import func
+
+from app import db
+from app.models import Category, ResourceCategory, ThrivResource
+
+
+class ResourceCounts:
+    """Counts the resources linked to every category at once, rather than with a query per
+    category.  Counts are computed on first use and then held for the lifetime of the
+    object, which is normally the current request (see resource_counts()).  With
+    rollup=True a category's count includes the counts of all of its descendants."""
+
+    def __init__(self):
+        self._approved = None
+        self._visible = None
+        self._children = None
+
+    def approved(self, category_id, rollup=False):
+        """The number of approved resources in the category."""
+        if self._approved is None:
+            rows = db.session.query(ResourceCategory.category_id, func.count(ResourceCategory.id))\
+                .join(ResourceCategory.resource)\
+                .filter(ThrivResource.approved == 'Approved')\
+                .group_by(ResourceCategory.category_id)\
+                .all()
+            self._approved = dict(rows)
+        return self._lookup(self._approved, category_id, rollup)
+
+    def visible(self, category_id, rollup=False):
+        """The number of resources in the category the current user may view."""
+        if self._visible is None:
+            user = g.user if 'user' in g and g.user else None
+            rows = db.session.query(ResourceCategory.category_id, func.count(ResourceCategory.id))\
+                .join(ResourceCategory.resource)\
+                .filter(ThrivResource.viewable_by(user))\
+                .group_by(ResourceCategory.category_id)\
+                .all()
+            self._visible = dict(rows)
+        return self._lookup(self._visible, category_id, rollup)
+
+    def _lookup(self, counts, category_id, rollup):
+        if not rollup:
+            return counts.get(category_id, 0)
+        if self._children is None:
+            self._children = defaultdict(list)
+            for id, parent_id in db.session.query(Category.id, Category.parent_id):
+                self._children[parent_id].append(id)
+        total = 0
+        pending = [category_id]
+        seen = set()
+        while pending:
+            id = pending.pop()
+            if id in seen:
+                continue
+            seen.add(id)
+            total += counts.get(id, 0)
+            pending.extend(self._children.get(id, []))
+        return total
+
+
+def resource_counts():
+    """The ResourceCounts shared by everything serialized during the current request."""
+    if not has_request_context():
+        return ResourceCounts()
+    current = request._get_current_object()
+    if not hasattr(current, 'resource_counts'):
+        current.resource_counts = ResourceCounts()
+    return current.resource_counts
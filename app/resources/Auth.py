@@ -5,7 +5,8 @@ from functools import wraps
 from itsdangerous import URLSafeTimedSerializer
 from sqlalchemy import or_, func
 
-from app import sso, app, RestException, db, auth, email_service
+from app import sso, app, RestException, db, auth, email_service, principal_cache
+from app.institution_domains import institution_domains
 from app.models import EmailLog
 from app.models import ThrivInstitution
 from app.models import User
@@ -55,10 +56,9 @@ def login(user_info):
             user.display_name = user.display_name + " " + user_info["sn"]
 
     # Link the user to their institution if possible
-    institutions = ThrivInstitution.query.all()
-    for i in institutions:
-        if i.domain and eppn.lower().endswith(i.domain.lower()):
-            user.institution = i
+    institution_id = institution_domains.match(eppn)
+    if institution_id is not None and institution_id != user.institution_id:
+        user.institution = db.session.query(ThrivInstitution).get(institution_id)
 
     db.session.add(user)
     db.session.commit()
@@ -99,6 +99,10 @@ def login_password():
         raise RestException(RestException.LOGIN_FAILURE)
     if user.email_verified:
         if user.is_correct_password(request_data["password"]):
+            if user.password_needs_rehash():
+                user.password = request_data["password"]
+                db.session.add(user)
+                db.session.commit()
             # redirect users back to the front end, include the new auth token.
             auth_token = user.encode_auth_token().decode()
             g.user = user
@@ -155,7 +159,7 @@ def verify_token(token):
     try:
         resp = User.decode_auth_token(token)
         if resp:
-            g.user = User.query.filter_by(id=resp).first()
+            g.user = principal_cache.get(resp)
     except:
         g.user = None
 
@@ -178,3 +182,4 @@ def login_optional(f):
         return f(*args, **kwargs)
 
     return decorated
+
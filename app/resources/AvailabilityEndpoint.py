@@ -15,8 +15,10 @@ class AvailabilityEndpoint(flask_restful.Resource):
         return self.schema.dump(model)
 
     def delete(self, id):
-        db.session.query(Availability).filter_by(id=id).delete()
-        db.session.commit()
+        model = db.session.query(Availability).filter_by(id=id).first()
+        if model is not None:
+            db.session.delete(model)
+            db.session.commit()
         return None
 
 
@@ -42,7 +44,9 @@ class ResourceAvailabilityEndpoint(flask_restful.Resource):
     def post(self, resource_id):
         request_data = request.get_json()
         availabilities = self.schema.load(request_data, many=True).data
-        db.session.query(Availability).filter_by(resource_id=resource_id).delete()
+        with db.session.no_autoflush:
+            for existing in db.session.query(Availability).filter_by(resource_id=resource_id):
+                db.session.delete(existing)
         for a in availabilities:
             db.session.add(a)
         db.session.commit()
@@ -1,9 +1,10 @@
 import flask_restful
 from flask import request
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import joinedload
 
 from app import db, RestException
+from app.category_tree import category_tree
+from app.conditional import conditional
 from app.models import Category
 from app.resources.schema import CategorySchema, ParentCategorySchema
 from app.resources.Auth import login_optional
@@ -13,8 +14,11 @@ class CategoryEndpoint(flask_restful.Resource):
     schema = CategorySchema()
 
     @login_optional
+    @conditional('category_tree', cache_control='public, no-cache')
     def get(self, id):
         category = db.session.query(Category).filter(Category.id == id).first()
+        if category is not None and category.path:
+            category = Category.load_tree(root=category)[0]
         return self.schema.dump(category)
 
     def delete(self, id):
@@ -40,13 +44,9 @@ class CategoryListEndpoint(flask_restful.Resource):
     categories_schema = CategorySchema(many=True)
 
     @login_optional
+    @conditional('category_tree', cache_control='public, no-cache')
     def get(self):
-        categories = db.session.query(Category)\
-            .options(joinedload(Category.children))\
-            .filter(Category.parent_id == None)\
-            .order_by(Category.display_order, Category.name)\
-            .all()
-        return self.categories_schema.dump(categories)
+        return category_tree.response()
 
     def post(self):
         request_data = request.get_json()
@@ -61,6 +61,7 @@ class RootCategoryListEndpoint(flask_restful.Resource):
     categories_schema = ParentCategorySchema(many=True)
 
     @login_optional
+    @conditional('category_tree', cache_control='public, no-cache')
     def get(self):
         categories = db.session.query(Category)\
             .filter(Category.parent_id == None)\
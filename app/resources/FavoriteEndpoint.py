@@ -3,6 +3,8 @@ from flask import g, request
 
 from app import db, RestException, auth
 from app.resources.schema import FavoriteSchema, UserFavoritesSchema
+from app.hydration import hydrate_resources, ResourceShape
+from app.index_outbox import queue_index_update
 from app.models import Favorite
 from app.models import ThrivResource
 
@@ -13,22 +15,31 @@ class UserFavoriteEndpoint(flask_restful.Resource):
 
     @auth.login_required
     def get(self):
-        schema = UserFavoritesSchema(many=True)
+        shape = ResourceShape.from_request(request.args)
+        schema = shape.nest(UserFavoritesSchema(many=True))
         favorites = db.session.query(Favorite) \
             .join(Favorite.resource) \
             .filter(Favorite.user_id == g.user.id) \
             .order_by(ThrivResource.segment_id.desc(), ThrivResource.last_updated.desc())\
             .all()
+        hydrate_resources([f.resource_id for f in favorites], shape)
         return schema.dump(favorites)
 
     @auth.login_required
     def post(self):
         request_data = request.get_json()
         favorites = self.schema.load(request_data, many=True).data
-        db.session.query(Favorite).filter_by(user_id=g.user.id).delete()
+        resource_ids = set()
+        # Deleted one by one, so the favorite counts of their resources go down
+        for favorite in db.session.query(Favorite).filter_by(user_id=g.user.id):
+            resource_ids.add(favorite.resource_id)
+            db.session.delete(favorite)
         for f in favorites:
+            resource_ids.add(f.resource_id)
             db.session.add(Favorite(user_id=g.user.id,
                                     resource_id=f.resource_id))
+        for resource_id in resource_ids:
+            queue_index_update(resource_id)
         db.session.commit()
         return self.get()
 
@@ -43,8 +54,11 @@ class FavoriteEndpoint(flask_restful.Resource):
         return self.schema.dump(model)
 
     def delete(self, id):
-        db.session.query(Favorite).filter_by(id=id).delete()
-        db.session.commit()
+        model = db.session.query(Favorite).filter_by(id=id).first()
+        if model is not None:
+            db.session.delete(model)
+            queue_index_update(model.resource_id)
+            db.session.commit()
         return None
 
 
@@ -55,5 +69,7 @@ class FavoriteListEndpoint(flask_restful.Resource):
         request_data = request.get_json()
         load_result = self.schema.load(request_data).data
         db.session.add(load_result)
+        db.session.flush()
+        queue_index_update(load_result.resource_id)
         db.session.commit()
         return self.schema.dump(load_result)
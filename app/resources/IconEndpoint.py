@@ -3,6 +3,7 @@ from flask import request
 from marshmallow import ValidationError
 
 from app import RestException, db, file_server
+from app.conditional import conditional
 from app.models import Icon
 from app.resources.schema import IconSchema
 
@@ -11,6 +12,7 @@ class IconEndpoint(flask_restful.Resource):
 
     schema = IconSchema()
 
+    @conditional('icon', cache_control='public, max-age=300')
     def get(self, id):
         model = db.session.query(Icon).filter_by(id=id).first()
         if model is None:
@@ -46,6 +48,7 @@ class IconListEndpoint(flask_restful.Resource):
     iconsSchema = IconSchema(many=True)
     iconSchema = IconSchema()
 
+    @conditional('icon', cache_control='public, max-age=300')
     def get(self):
         icons = db.session.query(Icon).all()
         return self.iconSchema.dump(icons, many=True)
@@ -3,6 +3,8 @@ from flask import request
 from marshmallow import ValidationError
 
 from app import RestException, db
+from app.conditional import conditional
+from app.index_outbox import queue_institution_index_updates
 from app.models import ThrivInstitution
 from app.resources.schema import ThrivInstitutionSchema
 
@@ -11,6 +13,7 @@ class InstitutionEndpoint(flask_restful.Resource):
 
     schema = ThrivInstitutionSchema()
 
+    @conditional('institution', cache_control='public, no-cache')
     def get(self, id):
         model = db.session.query(ThrivInstitution).filter_by(id=id).first()
         if model is None: raise RestException(RestException.NOT_FOUND)
@@ -24,15 +27,20 @@ class InstitutionEndpoint(flask_restful.Resource):
     def put(self, id):
         request_data = request.get_json()
         instance = db.session.query(ThrivInstitution).filter_by(id=id).first()
+        description = instance.description if instance else None
         updated, errors = self.schema.load(request_data, instance=instance)
         if errors: raise RestException(RestException.INVALID_OBJECT, details=errors)
         db.session.add(updated)
+        if instance is not None and updated.description != description:
+            # Who may see the institution's private resources is decided in the index
+            queue_institution_index_updates(instance.id)
         db.session.commit()
         return self.schema.dump(updated)
 
 
 class InstitutionListEndpoint(flask_restful.Resource):
 
+    @conditional('institution', cache_control='public, no-cache')
     def get(self):
         schema = ThrivInstitutionSchema(many=True)
         institutions = db.session.query(ThrivInstitution).all()
@@ -53,6 +61,7 @@ class InstitutionListEndpoint(flask_restful.Resource):
 
 class InstitutionAvailabilityListEndpoint(flask_restful.Resource):
 
+    @conditional('institution', cache_control='public, no-cache')
     def get(self):
         schema = ThrivInstitutionSchema(many=True)
         institutions = db.session.query(ThrivInstitution).filter(ThrivInstitution.hide_availability != True).all()
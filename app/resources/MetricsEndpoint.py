@@ -0,0 +1,17 @@
+import flask_restful
+
+from app import auth, compression, password_hasher, search_cache
+from app.wrappers import requires_roles
+
+
+class MetricsEndpoint(flask_restful.Resource):
+    """Reports the in-process caches and the password hashing pool of this worker."""
+
+    @auth.login_required
+    @requires_roles('Admin')
+    def get(self):
+        return {
+            'compression': compression.stats(),
+            'password_hashing': password_hasher.stats(),
+            'search_cache': search_cache.stats(),
+        }
@@ -1,10 +1,12 @@
 import flask_restful
-from flask import request
+from flask import g, request
 
 from app import db, RestException
+from app.hydration import hydrate_resources, ResourceShape
 from app.models import Category
 from app.models import ThrivResource
 from app.models import ResourceCategory
+from app.pagination import ResourcePage
 from app.resources.Auth import login_optional
 from app.resources.schema import CategorySchema, ThrivResourceSchema, ResourceCategorySchema, CategoryResourcesSchema, \
     ResourceCategoriesSchema
@@ -12,22 +14,39 @@ from app.resources.schema import CategorySchema, ThrivResourceSchema, ResourceCa
 
 
 class ResourceByCategoryEndpoint(flask_restful.Resource):
+    """Lists the resources in a category that the current user may view, a page at a
+    time (see ResourcePage).  The next page is in the Link header, and the total number
+    of viewable resources is in the X-Total-Count header."""
 
-    schema = CategoryResourcesSchema()
+    # Sort keys as (expression, descending) pairs, the id keeps the order stable.
+    sorts = {
+        'popularity': [(ThrivResource.favorite_count, True), (ThrivResource.name, False)],
+        'name': [(ThrivResource.name, False)],
+        'last_updated': [(ThrivResource.last_updated, True)],
+    }
 
     @login_optional
     def get(self, category_id):
-        resource_categories = db.session.query(ResourceCategory)\
+        sort = request.args.get('sort', 'popularity')
+        if sort not in self.sorts:
+            raise RestException(RestException.INVALID_ARGUMENT,
+                                details='sort must be one of %s' % ', '.join(sorted(self.sorts)))
+        page = ResourcePage(self.sorts[sort] + [(ThrivResource.id, False)])
+        shape = ResourceShape.from_request(request.args)
+        user = g.user if 'user' in g and g.user else None
+
+        query = db.session.query(ResourceCategory)\
             .join(ResourceCategory.resource)\
             .filter(ResourceCategory.category_id == category_id)\
-            .order_by(ThrivResource.name)\
-            .all()
-        viewable_resource_categories = []
-        resource_categories = sorted(resource_categories, key=lambda rc: rc.resource.favorite_count(), reverse=True)
-        for rc in resource_categories:
-            if rc.resource.user_may_view():
-                    viewable_resource_categories.append(rc)
-        return self.schema.dump(viewable_resource_categories, many=True)
+            .filter(ThrivResource.viewable_by(user))
+        total = query.count()
+        resource_categories = page.apply(query).all()
+        hydrate_resources([rc.resource_id for rc in resource_categories], shape)
+
+        last = resource_categories[-1].resource if resource_categories else None
+        schema = shape.nest(CategoryResourcesSchema(many=True))
+        return schema.dump(resource_categories).data, 200, \
+            page.headers(resource_categories, last, total)
 
 
 class CategoryByResourceEndpoint(flask_restful.Resource):
@@ -45,7 +64,9 @@ class CategoryByResourceEndpoint(flask_restful.Resource):
     def post(self, resource_id):
         request_data = request.get_json()
         resource_categories = self.schema.load(request_data, many=True).data
-        db.session.query(ResourceCategory).filter_by(resource_id=resource_id).delete()
+        with db.session.no_autoflush:
+            for existing in db.session.query(ResourceCategory).filter_by(resource_id=resource_id):
+                db.session.delete(existing)
         for c in resource_categories:
             db.session.add(ResourceCategory(resource_id=resource_id,
                            category_id=c.category_id))
@@ -61,8 +82,10 @@ class ResourceCategoryEndpoint(flask_restful.Resource):
         return self.schema.dump(model)
 
     def delete(self, id):
-        db.session.query(ResourceCategory).filter_by(id=id).delete()
-        db.session.commit()
+        model = db.session.query(ResourceCategory).filter_by(id=id).first()
+        if model is not None:
+            db.session.delete(model)
+            db.session.commit()
         return None
 
 class ResourceCategoryListEndpoint(flask_restful.Resource):
@@ -71,8 +94,10 @@ class ResourceCategoryListEndpoint(flask_restful.Resource):
     def post(self):
         request_data = request.get_json()
         load_result = self.schema.load(request_data).data
-        db.session.query(ResourceCategory).filter_by(resource_id=load_result.resource_id,
-                                                     category_id=load_result.category_id).delete()
+        with db.session.no_autoflush:
+            for existing in db.session.query(ResourceCategory).filter_by(
+                    resource_id=load_result.resource_id, category_id=load_result.category_id):
+                db.session.delete(existing)
         db.session.add(load_result)
         db.session.commit()
         return self.schema.dump(load_result)
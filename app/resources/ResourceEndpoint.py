@@ -7,28 +7,41 @@ import flask_restful
 from flask import jsonify, request, g
 from marshmallow import ValidationError
 
-from app import app, RestException, db, elastic_index, auth
+from app import app, RestException, db, auth
+from app.conditional import conditional
+from app.index_outbox import queue_index_update, queue_index_removal
 from app.models import Availability
 from app.models import Favorite
 from app.models import ResourceCategory
+from app.models import ResourceOwner
 from app.models import ThrivResource
 from app.models import ThrivType
 from app.models import ThrivSegment
+from app.hydration import ResourceShape
+from app.pagination import ResourcePage
 from app.resources.schema import ThrivResourceSchema
 from app.resources.Auth import login_optional
 
 
+def resource_version(id):
+    return db.session.query(ThrivResource.version).filter(ThrivResource.id == id).scalar()
+
+
 class ResourceEndpoint(flask_restful.Resource):
 
     @login_optional
+    @conditional('category', 'institution', 'type', 'segment', validator=resource_version,
+                 cache_control='private, no-cache', per_user=True)
     def get(self, id):
-        resource = db.session.query(ThrivResource).filter(
+        shape = ResourceShape.from_request(request.args)
+        resource = db.session.query(ThrivResource).options(*shape.load_options()).filter(
             ThrivResource.id == id).first()
         if resource is None:
             raise RestException(RestException.NOT_FOUND)
-        response_dump = ThrivResourceSchema().dump(resource)
-        response_dump[0]['event_date'] = [
-            response_dump[0]['starts'], response_dump[0]['ends']]
+        response_dump = shape.schema().dump(resource)
+        if 'starts' in response_dump[0] and 'ends' in response_dump[0]:
+            response_dump[0]['event_date'] = [
+                response_dump[0]['starts'], response_dump[0]['ends']]
         return response_dump
 
     @auth.login_required
@@ -36,14 +49,12 @@ class ResourceEndpoint(flask_restful.Resource):
         resource = db.session.query(ThrivResource).filter(
             ThrivResource.id == id).first()
         if resource.user_may_edit():
-            try:
-                elastic_index.remove_resource(resource)
-            except:
-                print("unable to remove record from elastic index, might not exist.")
+            queue_index_removal(resource.id)
             db.session.query(Availability).filter_by(resource_id=id).delete()
             db.session.query(ResourceCategory).filter_by(
                 resource_id=id).delete()
             db.session.query(Favorite).filter_by(resource_id=id).delete()
+            db.session.query(ResourceOwner).filter_by(resource_id=id).delete()
             db.session.query(ThrivResource).filter_by(id=id).delete()
             db.session.commit()
             return None
@@ -64,40 +75,52 @@ class ResourceEndpoint(flask_restful.Resource):
                     RestException.INVALID_OBJECT, details=errors)
             updated.last_updated = datetime.datetime.now()
             db.session.add(updated)
+            queue_index_update(updated.id)
             db.session.commit()
-            elastic_index.update_resource(updated)
             return ThrivResourceSchema().dump(updated)
         else:
             raise RestException(RestException.PERMISSION_DENIED)
 
 
 class ResourceListEndpoint(flask_restful.Resource):
+    """Lists the resources the current user may view, a page at a time (see ResourcePage),
+    with the next page in the Link header.  Resources in a segment are ordered by
+    (segment, last_updated, id), upcoming events by their start, and the unfiltered list
+    holds the most recently updated resources, grouped by segment within each page."""
 
     @login_optional
     def get(self):
         args = request.args
-        limit = eval(args["limit"]) if ("limit" in args) else 10
-        schema = ThrivResourceSchema(many=True)
+        shape = ResourceShape.from_request(args)
+        schema = shape.schema(many=True)
+        user = g.user if 'user' in g and g.user else None
+        viewable = db.session.query(ThrivResource)\
+            .options(*shape.load_options())\
+            .filter(ThrivResource.viewable_by(user))
         if("segment" in args):
             ithrivSegment = db.session.query(ThrivSegment).filter(
-                ThrivSegment.name == args["segment"]).limit(limit).one()
+                ThrivSegment.name == args["segment"]).first()
+            if ithrivSegment is None:
+                raise RestException(RestException.NOT_FOUND)
+            viewable = viewable.filter(ThrivResource.segment_id == ithrivSegment.id)
             if(args['segment'] == 'Event'):
-                resources = db.session.query(ThrivResource).filter(
-                    ThrivResource.segment_id == ithrivSegment.id).filter(
-                        ThrivResource.ends > datetime.datetime.utcnow()).order_by(ThrivResource.starts.asc()).all()
+                page = ResourcePage([(ThrivResource.starts, False), (ThrivResource.id, False)],
+                                    default_limit=10)
+                viewable = viewable.filter(ThrivResource.ends > datetime.datetime.utcnow())
             else:
-                resources = db.session.query(ThrivResource).filter(
-                    ThrivResource.segment_id == ithrivSegment.id).order_by(ThrivResource.segment_id.desc(), ThrivResource.last_updated.desc()).all()
+                page = ResourcePage([(ThrivResource.segment_id, True),
+                                     (ThrivResource.last_updated, True),
+                                     (ThrivResource.id, True)], default_limit=10)
+            resources = page.apply(viewable).all()
+            last = resources[-1] if resources else None
         else:
-            resources = db.session.query(ThrivResource).order_by(
-                ThrivResource.last_updated.desc()).limit(limit).from_self().order_by(
-                    ThrivResource.segment_id.desc(), ThrivResource.last_updated.desc()).all()
-        viewable_resources = []
-        for r in resources:
-            if r.user_may_view():
-                viewable_resources.append(r)
+            page = ResourcePage([(ThrivResource.last_updated, True), (ThrivResource.id, True)],
+                                default_limit=10)
+            recent = page.apply(viewable).all()
+            last = recent[-1] if recent else None
+            resources = sorted(recent, key=lambda r: r.segment_id, reverse=True)
 
-        return schema.dump(viewable_resources)
+        return schema.dump(resources).data, 200, page.headers(resources, last)
 
     @auth.login_required
     def post(self):
@@ -110,8 +133,9 @@ class ResourceListEndpoint(flask_restful.Resource):
         if errors:
             raise RestException(RestException.INVALID_OBJECT, details=errors)
         db.session.add(resource)
+        db.session.flush()
+        queue_index_update(resource.id)
         db.session.commit()
-        elastic_index.add_resource(resource)
         return schema.dump(resource)
 
 
@@ -121,11 +145,11 @@ class UserResourceEndpoint(flask_restful.Resource):
 
     @auth.login_required
     def get(self):
-        schema = ThrivResourceSchema(many=True)
-        resources = []
-        all_resources = db.session.query(ThrivResource).order_by(
-            ThrivResource.segment_id.desc(), ThrivResource.last_updated.desc()).all()
-        for r in all_resources:
-            if g.user.email in r.owners():
-                resources.append(r)
+        shape = ResourceShape.from_request(request.args)
+        schema = shape.schema(many=True)
+        resources = db.session.query(ThrivResource)\
+            .options(*shape.load_options())\
+            .filter(ThrivResource.owned_by(g.user.email))\
+            .order_by(ThrivResource.segment_id.desc(), ThrivResource.last_updated.desc())\
+            .all()
         return schema.dump(resources)
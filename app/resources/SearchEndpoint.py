@@ -2,10 +2,12 @@ import elasticsearch
 import flask_restful
 from flask import request, g
 
-from app import elastic_index, RestException
-from app.models import ThrivResource, Availability, ThrivInstitution
+from app import elastic_index, search_cache, RestException
+from app.conditional import current_versions
+from app.hydration import hydrate_resources, ResourceShape
 from app.models import Facet, FacetCount, Filter, Search
-from app.resources.schema import SearchSchema, ThrivResourceSchema
+from app.search_cache import SearchCache
+from app.resources.schema import SearchSchema
 from app.resources.Auth import login_optional
 
 
@@ -17,25 +19,34 @@ class SearchEndpoint(flask_restful.Resource):
 
         if errors:
             raise RestException(RestException.INVALID_OBJECT, details=errors)
-        try:
-            results = elastic_index.search_resources(search)
-        except elasticsearch.ElasticsearchException as e:
-            print(e)
-            raise RestException(RestException.ELASTIC_ERROR)
 
-        resources = []
-        filterredResults = []
-        for hit in results:
-            resource = ThrivResource.query.filter_by(id=hit.id).first()
-            if resource is not None and resource.user_may_view():
-                resources.append(resource)
-                filterredResults.append(hit)
-        search.total = results.hits.total
-        search.resources = ThrivResourceSchema().dump(
-            resources, many=True).data
+        user = g.user if 'user' in g and g.user else None
+        shape = ResourceShape.from_request(request.args)
+        versions = [version for version, _ in current_versions(SearchCache.VERSIONS)]
+        cache_key = search_cache.key(search, user, shape.key(), versions)
+        hits = search_cache.get(cache_key)
+        if hits is None:
+            try:
+                results = elastic_index.search_resources(search)
+            except elasticsearch.ElasticsearchException as e:
+                print(e)
+                raise RestException(RestException.ELASTIC_ERROR)
+            hits = {'ids': [hit.id for hit in results],
+                    'total': results.hits.total,
+                    'facets': self.facets(results)}
+            search_cache.set(cache_key, hits)
 
-        results.hits = filterredResults
-        search.facets = []
+        # Visibility is enforced by the Elasticsearch query, so every hit can be shown.
+        # Resources are dumped afresh each time, as what they say the user may do varies.
+        resources = hydrate_resources(hits['ids'], shape)
+        search.total = hits['total']
+        search.resources = shape.schema(many=True).dump(resources).data
+        search.facets = hits['facets']
+        return SearchSchema().dump(search).data
+
+    @staticmethod
+    def facets(results):
+        facets = []
         for facet_name in results.facets:
             if facet_name == "Approved":
                 if 'user' in g and g.user and g.user.role == "Admin":
@@ -45,7 +56,7 @@ class SearchEndpoint(flask_restful.Resource):
                             facet_name]:
                         facet.facetCounts.append(
                             FacetCount(category, hit_count, is_selected))
-                    search.facets.append(facet)
+                    facets.append(facet)
             else:
                 facet = Facet(facet_name)
                 facet.facetCounts = []
@@ -53,6 +64,5 @@ class SearchEndpoint(flask_restful.Resource):
                         facet_name]:
                     facet.facetCounts.append(
                         FacetCount(category, hit_count, is_selected))
-                search.facets.append(facet)
-
-        return SearchSchema().jsonify(search)
+                facets.append(facet)
+        return facets
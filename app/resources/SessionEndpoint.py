@@ -1,7 +1,8 @@
 import flask_restful
 from flask import g, jsonify
 
-from app import RestException, auth
+from app import RestException, auth, db
+from app.models import User
 from app.resources.schema import UserSchema
 
 
@@ -12,7 +13,8 @@ class SessionEndpoint(flask_restful.Resource):
     @auth.login_required
     def get(self):
         if "user" in g:
-            return jsonify(self.schema.dump(g.user).data)
+            user = db.session.query(User).get(g.user.id)
+            return jsonify(self.schema.dump(user).data)
         else:
             return None
 
@@ -3,6 +3,7 @@ from flask import request
 from marshmallow import ValidationError
 
 from app import RestException, db
+from app.conditional import conditional
 from app.models import ThrivType
 from app.models import ThrivSegment
 from app.resources.schema import ThrivTypeSchema
@@ -13,6 +14,7 @@ class TypeEndpoint(flask_restful.Resource):
 
     schema = ThrivTypeSchema()
 
+    @conditional('type', cache_control='public, no-cache')
     def get(self, id):
         model = db.session.query(ThrivType).filter_by(id=id).first()
         if model is None: raise RestException(RestException.NOT_FOUND)
@@ -38,6 +40,7 @@ class TypeListEndpoint(flask_restful.Resource):
     typesSchema = ThrivTypeSchema(many=True)
     typeSchema = ThrivTypeSchema()
 
+    @conditional('type', cache_control='public, no-cache')
     def get(self):
         types = db.session.query(ThrivType).all()
         return self.typesSchema.dump(types)
@@ -58,6 +61,7 @@ class SegmentListEndpoint(flask_restful.Resource):
     
     segmentTypesSchema = ThrivSegmentSchema(many=True)
 
+    @conditional('segment', cache_control='public, max-age=300')
     def get(self):
         segment_types = db.session.query(ThrivSegment).all()
         return self.segmentTypesSchema.dump(segment_types)
\ No newline at end of file
@@ -1,8 +1,8 @@
 from flask_marshmallow.sqla import ModelSchema
 from marshmallow import fields, post_load
-from sqlalchemy import func
 
-from app import ma, db
+from app import ma
+from app.resource_counts import resource_counts
 from app.models import Availability
 from app.models import Category
 from app.models import Icon
@@ -125,7 +125,7 @@ class ThrivResourceSchema(ModelSchema):
     type_id = fields.Integer(required=False, allow_none=True)
     segment_id = fields.Integer(required=False, allow_none=True)
     approved = fields.String(required=False, allow_none=True)
-    favorite_count = fields.Integer(required=False, allow_none=True)
+    favorite_count = fields.Integer(dump_only=True)
     private = fields.Boolean(required=False, allow_none=True)
     location = fields.String(required=False, allow_none=True)
     starts = fields.DateTime(required=False, allow_none=True)
@@ -182,20 +182,11 @@ class CategorySchema(ModelSchema):
     })
 
     def get_resource_count_for_current_user(self, obj):
-        """This takes the current users viewable resources into account, but is a little too slow."""
-        category_resources = obj.category_resources
-        resource_count = 0
-        for cr in category_resources:
-            if cr.resource.user_may_view():
-                resource_count += 1
-        return resource_count
+        """This takes the current users viewable resources into account."""
+        return resource_counts().visible(obj.id)
 
     def get_resource_count(self, obj):
-        query = db.session.query(ResourceCategory).join(ResourceCategory.resource)\
-            .filter(ResourceCategory.category_id == obj.id).filter(ThrivResource.approved == 'Approved')
-        count_q = query.statement.with_only_columns(
-            [func.count()]).order_by(None)
-        return query.session.execute(count_q).scalar()
+        return resource_counts().approved(obj.id)
 
 
 class ResourceCategoriesSchema(ModelSchema):
@@ -9,9 +9,11 @@ class RestException(Exception):
     NOT_YOUR_ACCOUNT = {'code': 'permission_denied', 'message': 'You may not edit another users account.'}
     PERMISSION_DENIED = {'code': 'permission_denied', 'message': 'You are not authorized to make this call.'}
     INVALID_OBJECT = {'code': 'invalid_object', 'message': 'Unable to save the provided object.'}
+    INVALID_ARGUMENT = {'code': 'invalid_argument', 'message': 'One of the request parameters is not valid.'}
     CAN_NOT_DELETE = {'code': 'can_not_delete', 'message': 'You must delete all dependent records first.'}
     LOGIN_FAILURE = {'code': 'login_failure', 'message': 'The credentials you supplied are incorrect.'}
     EMAIL_EXISTS = {'code': 'duplicate_email', 'message': 'The email you provided is already in use.'}
+    SERVER_BUSY = {'code': 'server_busy', 'message': 'The server is busy, please try again shortly.', 'status_code': 503}
     CONFIRM_EMAIL = {'code': 'confirm_email', 'message': 'You must confirm your email address before signing in.'}
 
     def __init__(self, payload, status_code=None, details=None):
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class SearchCache:
+    """An in-process LRU cache of executed searches whose entries also expire after a
+    time to live.  Entries hold what the index returned, the ids of the hits, their total
+    and the facets, not the resources themselves, which are hydrated and dumped for each
+    request so that fields such as user_may_edit are worked out for whoever is asking.
+    Keys include the data versions in VERSIONS, which every process reads from the
+    database: 'search_index' moves when the index outbox worker or a (re)index has
+    written to the index.  So no process serves hits from before a change once it is in
+    the index, and entries made in between are never looked up again."""
+
+    VERSIONS = ('search_index',)
+
+    def __init__(self, app):
+        settings = app.config.get('SEARCH_CACHE', {})
+        self.max_size = settings.get('max_size', 512)
+        self.ttl = settings.get('ttl', 30)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(search, user, shape=None, versions=None):
+        """Normalizes a search, the fields requested, the current VERSIONS and the
+        visibility class of the user running it into a key.
+        Hits only depend on the user's role and institution, so everyone anonymous
+        shares entries, as do users of the same role and institution.  The exception is a
+        user who owns resources, who may see some the rest of their class can't, whose
+        email is added to the key so their hits are kept to themselves."""
+        if user is None:
+            visibility = None
+        else:
+            visibility = [user.role, user.institution_id]
+            if user.email and SearchCache.owns_resources(user):
+                visibility.append(user.email)
+        return json.dumps([(search.query or '').strip(), search.jsonFilters(), search.sort,
+                           search.start, search.size, visibility, shape, versions],
+                          sort_keys=True, default=str)
+
+    @staticmethod
+    def owns_resources(user):
+        """Whether the user owns any resource, an indexed lookup on resource_owner."""
+        from app import db
+        from app.models import ThrivResource
+        owned = db.session.query(ThrivResource.id).filter(ThrivResource.owned_by(user.email))
+        return db.session.query(owned.exists()).scalar()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
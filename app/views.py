@@ -1,5 +1,5 @@
 from flask import jsonify, url_for, redirect, g, request, Blueprint
-from app import app, db, sso, auth, RestException
+from app import app, db, sso, auth, RestException, response_encoder
 import flask_restful
 from flask_restful import reqparse
 import urllib
@@ -7,6 +7,7 @@ import urllib
 from app.resources.Auth import auth_blueprint
 from app.resources.FileEndpoint import FileListEndpoint, FileEndpoint
 from app.resources.IconEndpoint import IconListEndpoint, IconEndpoint
+from app.resources.MetricsEndpoint import MetricsEndpoint
 from app.resources.ResourceAndCategoryEndoint import ResourceByCategoryEndpoint, CategoryByResourceEndpoint, \
     ResourceCategoryEndpoint, ResourceCategoryListEndpoint
 from app.resources.ResourceEndpoint import ResourceListEndpoint, ResourceEndpoint, UserResourceEndpoint
@@ -37,6 +38,7 @@ class IThrivApi(flask_restful.Api):
 
 api_blueprint = Blueprint("api", __name__, url_prefix='/api')
 api = IThrivApi(api_blueprint)
+api.representation('application/json')(response_encoder.output_json)
 app.register_blueprint(api_blueprint)
 app.register_blueprint(auth_blueprint)
 app.register_blueprint(tracking_blueprint)
@@ -73,7 +75,8 @@ endpoints = [(ResourceListEndpoint, '/resource'),
              (FavoriteEndpoint, '/favorite/<id>'),
              (UserFavoriteEndpoint, '/session/favorite'),
              (UserResourceEndpoint, '/session/resource'),
-             (FileEndpoint, '/file/<id>'), (FileListEndpoint, '/file')]
+             (FileEndpoint, '/file/<id>'), (FileListEndpoint, '/file'),
+             (MetricsEndpoint, '/metrics')]
 
 
 @app.route('/', methods=['GET'])
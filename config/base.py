@@ -51,7 +51,58 @@ ELASTIC_SEARCH = {
     'index_prefix': ''.join(['ithriv-', conn_info['ENV']]),
     'timeout': 20,
     'verify_certs': False,
-    'use_ssl': False
+    'use_ssl': False,
+    'bulk_chunk_size': 500,
+    'bulk_thread_count': 4
+}
+
+# Cache of executed searches, entries expire after ttl seconds
+SEARCH_CACHE = {
+    'max_size': 512,
+    'ttl': 30
+}
+
+# bcrypt work factor, existing hashes are upgraded when their users log in
+BCRYPT_LOG_ROUNDS = 12
+
+# Password hashing runs on a pool of workers, calls beyond max_pending waiting for one
+# are turned away with a 503
+PASSWORD_HASHING = {
+    'workers': 2,
+    'max_pending': 8,
+    'timeout': 10
+}
+
+# JSON encoding of API responses, 'orjson' is fast and 'json' writes the same compact bytes
+# with the standard library.  Arrays longer than stream_threshold are sent chunk_size
+# items at a time.
+RESPONSE_ENCODER = {
+    'backend': 'orjson',
+    'stream_threshold': 1000,
+    'chunk_size': 200
+}
+
+# Responses of at least min_size bytes are compressed, those that are the same for everyone
+# are compressed once per version and kept in a cache of cache_size entries
+COMPRESSION = {
+    'min_size': 1024,
+    'gzip_level': 6,
+    'brotli_quality': 5,
+    'cache_size': 64
+}
+
+# Cache of authenticated users. Entries are dropped when their user changes in this process
+# and otherwise expire after ttl seconds, the longest another process may use a stale role.
+PRINCIPAL_CACHE = {
+    'max_size': 4096,
+    'ttl': 30
+}
+
+# Search index outbox worker settings
+INDEX_OUTBOX = {
+    'batch_size': 100,
+    'max_attempts': 8,
+    'poll_interval': 1
 }
 
 # SMTP Email Settings
@@ -1,10 +1,15 @@
 # Set enivoronment variable to testing before loading.
+import csv
+import hashlib
 import os
+import tempfile
 import unittest
+from unittest.mock import patch
 
-from app import app, data_loader, db, elastic_index
+from app import app, data_loader, db, elastic_index, file_server
 
-from app.models import Availability, ThrivResource, User
+from app.model_events import current_version
+from app.models import Availability, Category, Icon, ThrivInstitution, ThrivResource, User
 
 os.environ["APP_CONFIG_FILE"] = '../config/qa.py'
 
@@ -33,3 +38,104 @@ class TestCase(unittest.TestCase):
     def test_load_users(self):
         self.loader.load_users()
         self.assertEqual(6, db.session.query(User).count())
+
+    def test_bulk_load_matches_the_csv_files(self):
+        self.loader = data_loader.DataLoader(directory="example_data", batch_size=100)
+        self.loader.load_institutions()
+        self.loader.load_resources()
+        self.loader.load_availability()
+        with patch.object(file_server, '_stored_md5', return_value=None), \
+                patch.object(file_server, '_save_file', return_value="https://s3/icon.svg"):
+            self.loader.load_icons()
+        self.loader.load_categories()
+        self.loader.load_resource_categories()
+        self.loader.load_users()
+        self.loader.load_user_favorites()
+
+        self.assertEqual(460, db.session.query(ThrivResource).count())
+        resource = db.session.query(ThrivResource).get(1)
+        self.assertEqual("Medical Labs", resource.name)
+        self.assertEqual("UVA", resource.institution.name)
+        self.assertEqual("Cost Recovery", resource.cost)
+        self.assertEqual(["WMP4C@hscmail.mcc.virginia.edu"], resource.owners())
+        self.assertEqual(6, len(resource.availabilities))
+        self.assertEqual(2, len(resource.resource_categories))
+        for resource in db.session.query(ThrivResource).filter(ThrivResource.favorite_count > 0):
+            self.assertEqual(len(resource.favorites), resource.favorite_count)
+        self.assertEqual(1, db.session.query(ThrivInstitution).filter(
+            ThrivInstitution.name == "UVA").count())
+        self.assertTrue(current_version('resource') > 0)
+
+    def test_bad_rows_are_rejected_with_their_line_numbers(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "resources.csv"), "w") as f:
+            f.write('#,Resource,Institution,TYPE,Email,Websites,Description,Segment\n'
+                    '1,Medical Labs,UVA,Education,a@virginia.edu,,"Two\nlines",Resource\n'
+                    'two,Pathology,UVA,Education,,,,Resource\n'
+                    '3,,UVA,Education,,,,Resource\n'
+                    '1,Medical Labs again,UVA,Education,,,,Resource\n'
+                    '5,Dermatology,UVA,Education,,,,\n')
+        loader = data_loader.DataLoader(directory=directory, errors_directory=directory)
+        loader.load_resources()
+
+        self.assertEqual(1, db.session.query(ThrivResource).count())
+        self.assertEqual("Two\nlines", db.session.query(ThrivResource).get(1).description)
+        with open(os.path.join(directory, "resources.csv.rejects.csv"), newline='') as f:
+            rejects = list(csv.reader(f))[1:]
+        self.assertEqual(['4', '5', '6', '7'], [reject[0] for reject in rejects])
+        self.assertIn('whole number', rejects[0][1])
+        self.assertIn('required', rejects[1][1])
+        self.assertIn('already', rejects[2][1])
+        self.assertIn('Segment', rejects[3][1])
+
+    def test_rows_that_would_break_constraints_are_rejected(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, "categories.csv"), "w") as f:
+            f.write('Category ID,Parent ID,Category Name,Icon ID\n'
+                    '1,,Root,\n'
+                    '2,3,Child before its parent,\n'
+                    '3,1,Child,\n'
+                    '1,,Root again,\n'
+                    '4,1,Missing icon,99\n')
+        with open(os.path.join(directory, "users.csv"), "w") as f:
+            f.write('id,email_address,display_name,password\n'
+                    '1,a@virginia.edu,A,secret\n'
+                    '2,a@virginia.edu,A again,secret\n'
+                    '1,b@virginia.edu,B,secret\n')
+        loader = data_loader.DataLoader(directory=directory, errors_directory=directory)
+        loader.load_categories()
+        loader.load_users()
+
+        self.assertEqual({1, 3}, {id for (id,) in db.session.query(Category.id)})
+        self.assertEqual(["a@virginia.edu"], [email for (email,) in db.session.query(User.email)])
+        with open(os.path.join(directory, "categories.csv.rejects.csv"), newline='') as f:
+            rejects = list(csv.reader(f))[1:]
+        self.assertEqual(['3', '5', '6'], [reject[0] for reject in rejects])
+        self.assertIn('no category with id 3', rejects[0][1])
+        self.assertIn('already', rejects[1][1])
+        self.assertIn('no icon', rejects[2][1])
+        with open(os.path.join(directory, "users.csv.rejects.csv"), newline='') as f:
+            rejects = list(csv.reader(f))[1:]
+        self.assertEqual(['3', '4'], [reject[0] for reject in rejects])
+        self.assertIn('email', rejects[0][1])
+        self.assertIn('id 1', rejects[1][1])
+
+    def test_load_icons_uploads_only_changed_files(self):
+        with open("example_data/icons/center.svg", 'rb') as f:
+            unchanged = hashlib.md5(f.read()).hexdigest()
+        uploads = []
+
+        def save_file(data, key, mime_type):
+            uploads.append((key, mime_type))
+            return "https://s3/" + key
+
+        with patch.object(file_server, '_stored_md5', return_value=unchanged), \
+                patch.object(file_server, '_save_file', side_effect=save_file):
+            self.loader.load_icons(thread_count=4)
+
+        icons = db.session.query(Icon).count()
+        self.assertTrue(icons > 30)
+        self.assertEqual(icons - 1, len(uploads))
+        self.assertEqual({'image/svg+xml'}, {mime_type for key, mime_type in uploads})
+        self.assertNotIn('102.svg', ' '.join(key for key, mime_type in uploads))
+        self.assertIsNotNone(db.session.query(Icon).get(102).url)
@@ -0,0 +1,24 @@
+"""empty message
+
+Revision ID: a7c3e0f85b21
+Revises: f3b9d27c6a18
+Create Date: 2019-11-27 14:05:32.918440
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e0f85b21'
+down_revision = 'f3b9d27c6a18'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('resource', sa.Column('version', sa.Integer(), server_default='0', nullable=False))
+
+
+def downgrade():
+    op.drop_column('resource', 'version')
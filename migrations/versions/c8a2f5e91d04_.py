@@ -0,0 +1,24 @@
+"""empty message
+
+Revision ID: c8a2f5e91d04
+Revises: 71d5b3f0c9a6
+Create Date: 2019-11-21 10:12:44.310587
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8a2f5e91d04'
+down_revision = '71d5b3f0c9a6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('data_version', sa.Column('last_updated', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('data_version', 'last_updated')
@@ -1,4 +1,5 @@
 import datetime
+import gzip
 import json
 import math
 import os
@@ -6,27 +7,42 @@ import quopri
 import random
 import re
 import string
+import threading
 import base64
 import unittest
 
-from app import app, db, elastic_index
+from app import app, bcrypt, compression, db, elastic_index, password_hasher, principal_cache, \
+    response_encoder, search_cache, RestException
+from app.password_hasher import PasswordHasher
+from app.response_encoder import ResponseEncoder
+from app.category_tree import category_tree
+from app.data_loader import DataLoader
 from app.email_service import TEST_MESSAGES
+from app.index_outbox import IndexOutboxWorker, queue_index_update
+from app.institution_domains import institution_domains
+from app.resource_counts import ResourceCounts
 from app.model.resource_category import ResourceCategory
 from app.model.availability import Availability
 from app.model.category import Category
 from app.model.favorite import Favorite
 from app.model.resource import ThrivResource
 from app.model.type import ThrivType
+from app.models import ThrivSegment
 from app.model.institution import ThrivInstitution
 from app.model.icon import Icon
 from app.model.user import User
+from app.models import IndexOutbox, ResourceOwner, Search
 from app.model.email_log import EmailLog
 from app.model.uploaded_file import UploadedFile
+from app.hydration import hydrate_resources
 from app.resources.schema import CategorySchema, IconSchema, ThrivTypeSchema, \
-    UserSchema, FileSchema
+    UserSchema, FileSchema, ThrivResourceSchema
 from botocore.vendored import requests
+from flask import g
+from contextlib import contextmanager
+from unittest.mock import patch
 from io import BytesIO
-from sqlalchemy import or_
+from sqlalchemy import event, or_
 
 # Set environment variable to testing before loading.
 # IMPORTANT - Environment must be loaded before app, models, etc....
@@ -42,6 +58,9 @@ class TestCase(unittest.TestCase):
         self.app = app.test_client()
         self.ctx = app.test_request_context()
         self.ctx.push()
+        category_tree.invalidate()
+        principal_cache.invalidate()
+        institution_domains.invalidate()
 
     def tearDown(self):
         self.ctx.pop()
@@ -621,6 +640,24 @@ class TestCase(unittest.TestCase):
         response = json.loads(rv.get_data(as_text=True))
         self.assertEqual(response["owner"], 'Mac Daddy Test')
 
+    def test_resource_owners_follow_owner_field(self):
+        r = self.construct_resource(owner="oscar@sesamestreet.com; bigbird@sesamestreet.com")
+        self.assertEqual(["oscar@sesamestreet.com", "bigbird@sesamestreet.com"], r.owners())
+        self.assertEqual(2, db.session.query(ResourceOwner).count())
+
+        r.owner = "bigbird@sesamestreet.com, elmo@sesamestreet.com bigbird@sesamestreet.com"
+        db.session.commit()
+        self.assertEqual(["bigbird@sesamestreet.com", "elmo@sesamestreet.com"], r.owners())
+        emails = [o.email for o in db.session.query(ResourceOwner).order_by(ResourceOwner.id)]
+        self.assertEqual(["bigbird@sesamestreet.com", "elmo@sesamestreet.com"], emails)
+        owned = db.session.query(ThrivResource)\
+            .filter(ThrivResource.owned_by("elmo@sesamestreet.com")).all()
+        self.assertEqual([r.id], [o.id for o in owned])
+
+        rv = self.app.delete('/api/resource/%i' % r.id, headers=self.logged_in_headers())
+        self.assertSuccess(rv)
+        self.assertEqual(0, db.session.query(ResourceOwner).count())
+
     def test_resource_has_contact_information(self):
         self.construct_resource(
             contact_email='thor@disney.com',
@@ -886,6 +923,140 @@ class TestCase(unittest.TestCase):
         self.assertEqual(response[1]['name'], 'c2')
         self.assertEqual(response[2]['name'], 'c3')
 
+    def test_list_categories_is_served_from_snapshot_with_etag(self):
+        self.construct_category(name="c1")
+        db.session.commit()
+        rv = self.app.get('/api/category', content_type="application/json")
+        self.assertSuccess(rv)
+        etag = rv.headers['ETag']
+        self.assertIsNotNone(etag)
+
+        with self.count_queries() as statements:
+            rv = self.app.get('/api/category', content_type="application/json",
+                              headers={'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+        self.assertEqual(1, len(statements))
+
+        self.construct_category(name="c2")
+        db.session.commit()
+        rv = self.app.get('/api/category', content_type="application/json",
+                          headers={'If-None-Match': etag})
+        self.assertSuccess(rv)
+        self.assertNotEqual(etag, rv.headers['ETag'])
+        self.assertEqual(2, len(json.loads(rv.get_data(as_text=True))))
+
+    def test_read_endpoints_answer_304_without_the_database_or_schemas(self):
+        r = self.construct_resource(name="Bowcaster")
+        for url in ['/api/type', '/api/segment', '/api/icon', '/api/institution',
+                    '/api/category/root', '/api/resource/%i' % r.id]:
+            rv = self.app.get(url, content_type="application/json")
+            self.assertSuccess(rv)
+            etag = rv.headers['ETag']
+            self.assertIn('Cache-Control', rv.headers)
+
+            with self.count_queries() as statements, \
+                    patch('marshmallow.Schema.dump', side_effect=AssertionError(url)):
+                rv = self.app.get(url, content_type="application/json",
+                                  headers={'If-None-Match': etag})
+            self.assertEqual(304, rv.status_code, url)
+            # A single resource also checks its own version.
+            self.assertEqual(2 if url.startswith('/api/resource/') else 1,
+                             len(statements), url)
+            self.assertIn('data_version', statements[0])
+
+        # Changing a resource changes its validator, as does who is asking.
+        r.name = "Lightsaber"
+        db.session.commit()
+        rv = self.app.get('/api/resource/%i' % r.id, content_type="application/json",
+                          headers={'If-None-Match': etag})
+        self.assertSuccess(rv)
+        self.assertNotEqual(etag, rv.headers['ETag'])
+        self.assertIsNone(rv.headers.get('Last-Modified'))
+        headers = self.logged_in_headers()
+        rv = self.app.get('/api/resource/%i' % r.id, content_type="application/json")
+        etag = rv.headers['ETag']
+        headers['If-None-Match'] = etag
+        rv = self.app.get('/api/resource/%i' % r.id, content_type="application/json",
+                          headers=headers)
+        self.assertSuccess(rv)
+        self.assertEqual('private, no-cache', rv.headers['Cache-Control'])
+        self.assertIn('Authorization', rv.headers['Vary'])
+
+    def test_resource_etag_only_changes_with_that_resource(self):
+        self.construct_various_users()
+        u = User.query.filter_by(eppn=self.test_eppn).first()
+        r = self.construct_resource(name="Bowcaster")
+        other = self.construct_resource(name="Blaster")
+        institution = self.construct_institution(name="Kashyyyk")
+        url = '/api/resource/%i' % r.id
+
+        def etag_of():
+            rv = self.app.get(url, content_type="application/json")
+            self.assertSuccess(rv)
+            return rv.headers['ETag']
+
+        def not_modified(etag):
+            rv = self.app.get(url, content_type="application/json",
+                              headers={'If-None-Match': etag})
+            return rv.status_code == 304
+
+        etag = etag_of()
+        self.construct_favorite(u, other)
+        other.name = "Heavy Blaster"
+        db.session.commit()
+        self.assertTrue(not_modified(etag))
+
+        # Rows shown with the resource change it, however they are written.
+        favorite = self.construct_favorite(u, r)
+        self.assertFalse(not_modified(etag))
+        etag = etag_of()
+        self.assertTrue(not_modified(etag))
+
+        rv = self.app.post('/api/resource/%i/availability' % r.id, data=json.dumps([{
+            "resource_id": r.id, "institution_id": institution.id, "available": True}]),
+            content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertFalse(not_modified(etag))
+        etag = etag_of()
+
+        availability_id = json.loads(rv.get_data(as_text=True))[0]['id']
+        self.assertSuccess(self.app.delete('/api/availability/%i' % availability_id))
+        self.assertFalse(not_modified(etag))
+        etag = etag_of()
+
+        self.assertSuccess(self.app.delete('/api/favorite/%i' % favorite.id))
+        self.assertFalse(not_modified(etag))
+
+    def test_responses_are_compressed_once_per_version(self):
+        for i in range(20):
+            self.construct_category(name="Category %i" % i, description="A rather long description")
+        db.session.commit()
+        rv = self.app.get('/api/category', content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertNotIn('Content-Encoding', rv.headers)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        body = rv.get_data()
+
+        misses = compression.stats()['misses']
+        for _ in range(2):
+            rv = self.app.get('/api/category', content_type="application/json",
+                              headers={'Accept-Encoding': 'br;q=0, gzip'})
+            self.assertSuccess(rv)
+            self.assertEqual('gzip', rv.headers['Content-Encoding'])
+            self.assertEqual(body, gzip.decompress(rv.get_data()))
+        self.assertEqual(misses + 1, compression.stats()['misses'])
+
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        rv = self.app.get('/api/category', content_type="application/json",
+                          headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(304, rv.status_code)
+
+        # Small responses are not worth compressing.
+        rv = self.app.get('/api/segment', content_type="application/json",
+                          headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', rv.headers)
+
     def test_list_categories_sorts_in_display_order(self):
         self.construct_category(
             name="M", description="M description", display_order=1)
@@ -1025,6 +1196,42 @@ class TestCase(unittest.TestCase):
         self.assertEqual(1, len(response))
         self.assertEqual(1, len(response[0]["children"]))
 
+    def test_category_path_covers_the_whole_hierarchy(self):
+        root = self.construct_category(name="Root")
+        root.color = "#A52A2A"
+        parent = root
+        categories = [root]
+        for i in range(5):
+            parent = self.construct_category(
+                name="Level %i" % (i + 1), description="A Child Category", parent=parent)
+            categories.append(parent)
+        db.session.commit()
+        leaf = categories[-1]
+        self.assertEqual('/' + '/'.join(str(c.id) for c in categories) + '/', leaf.path)
+        self.assertEqual(5, leaf.calculate_level())
+        self.assertEqual("#A52A2A", leaf.calculate_color())
+        self.assertEqual([c.id for c in categories[:-1]], [c.id for c in leaf.ancestors()])
+        self.assertEqual(6, categories[0].subtree_query().count())
+        self.assertEqual(3, categories[3].subtree_query().count())
+
+        # Moving a branch rewrites the paths of everything below it.
+        categories[3].parent = root
+        db.session.commit()
+        self.assertEqual(3, leaf.calculate_level())
+        self.assertEqual(3, len(leaf.ancestors()))
+
+        with self.count_queries() as queries:
+            tree = Category.load_tree()
+        self.assertEqual(1, len(queries))
+        self.assertEqual(1, len(tree))
+        self.assertEqual(["Level 1", "Level 3"], [c.name for c in tree[0].children])
+        level = tree[0].children[1]
+        depth = 0
+        while level.children:
+            level = level.children[0]
+            depth += 1
+        self.assertEqual(2, depth)
+
     def test_delete_category(self):
         c = self.construct_category()
         self.assertEqual(1, db.session.query(Category).count())
@@ -1034,6 +1241,8 @@ class TestCase(unittest.TestCase):
 
     def search(self, query, user=None):
         """Executes a query as the given user, returning the resulting search results object."""
+        IndexOutboxWorker().drain()
+        search_cache.invalidate()
         rv = self.app.post(
             '/api/search',
             data=json.dumps(query),
@@ -1043,8 +1252,24 @@ class TestCase(unittest.TestCase):
         self.assertSuccess(rv)
         return json.loads(rv.get_data(as_text=True))
 
+    @contextmanager
+    def count_queries(self):
+        """Counts the SQL statements executed within the block."""
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
     def search_anonymous(self, query):
         """Executes a query as an anonymous user, returning the resulting search results object."""
+        IndexOutboxWorker().drain()
+        search_cache.invalidate()
         rv = self.app.post(
             '/api/search',
             data=json.dumps(query),
@@ -1270,6 +1495,318 @@ class TestCase(unittest.TestCase):
         search_results = self.search(zorpy_query)
         self.assertEqual(1, len(search_results["resources"]))
 
+    def test_search_hydration_query_count_is_flat(self):
+        parent = self.construct_category(name="Parent")
+        category = self.construct_category(name="Child", parent=parent)
+        u = self.construct_user()
+
+        def add_resources(count):
+            for i in range(count):
+                r = self.construct_resource(
+                    name="Cloud City Tour %i" % i, approved="Approved",
+                    available_to="Bespin University")
+                db.session.add(ResourceCategory(resource=r, category=category))
+                db.session.add(Favorite(user_id=u.id, resource_id=r.id))
+            db.session.commit()
+
+        def hydrate_and_dump():
+            db.session.expire_all()
+            ids = [r.id for r in db.session.query(ThrivResource.id).all()]
+            with self.count_queries() as statements:
+                resources = hydrate_resources(reversed(ids))
+                ThrivResourceSchema(many=True).dump(resources)
+            self.assertEqual(list(reversed(ids)), [r.id for r in resources])
+            return len(statements)
+
+        add_resources(2)
+        small_page = hydrate_and_dump()
+        add_resources(20)
+        large_page = hydrate_and_dump()
+        self.assertEqual(small_page, large_page)
+
+    def construct_visibility_corpus(self, rng, size=40):
+        """Resources and users covering the combinations of ownership, privacy, approval,
+        role and institution (including missing institutions and descriptions) that
+        user_may_view and user_may_edit distinguish between. Users include None, for
+        anonymous."""
+        institutions = [
+            self.construct_institution(name="Jedi Temple", domain="jedi.org",
+                                       description="Coruscant"),
+            self.construct_institution(name="Jedi Archives", domain="archives.jedi.org",
+                                       description="Coruscant"),
+            self.construct_institution(name="Sith Academy", domain="sith.net",
+                                       description="Korriban"),
+            self.construct_institution(name="Hutt Cartel", domain="hutt.com",
+                                       description=None),
+            None]
+        emails = ["yoda@jedi.org", "vader@sith.net", "jabba@hutt.com", "rey@jakku.com"]
+
+        resources = []
+        for i in range(size):
+            owners = rng.sample(emails, rng.randint(0, 2))
+            resources.append(self.construct_resource(
+                name="Holocron %i" % i,
+                institution=rng.choice(institutions),
+                owner=rng.choice(["; ", ", ", " "]).join(owners) if owners else None,
+                approved=rng.choice(["Approved", "Unapproved", None]),
+                private=rng.choice([True, False, None])))
+
+        users = [None]
+        for i, email in enumerate(emails + ["padawan%i@jedi.org" % n for n in range(16)]):
+            users.append(self.construct_user(
+                id=5000 + i,
+                eppn=email,
+                email=email,
+                role=rng.choice(["User", "Admin"]),
+                institution=rng.choice(institutions)))
+        return resources, users
+
+    def test_search_visibility_matches_user_may_view(self):
+        resources, users = self.construct_visibility_corpus(random.Random(1138))
+        for user in users:
+            g.user = user
+            search = Search(size=len(resources))
+            es_ids = {hit.id for hit in elastic_index.search_resources(search)}
+            python_ids = {r.id for r in resources if r.user_may_view()}
+            self.assertEqual(python_ids, es_ids,
+                             "Visibility differs for %s" % (user.email if user else "anonymous"))
+        g.user = None
+
+    def test_sql_visibility_matches_user_may_view_and_edit(self):
+        resources, users = self.construct_visibility_corpus(random.Random(501), size=150)
+        for user in users:
+            g.user = user
+            name = user.email if user else "anonymous"
+            viewable = {id for id, in db.session.query(ThrivResource.id)
+                        .filter(ThrivResource.viewable_by(user))}
+            self.assertEqual({r.id for r in resources if r.user_may_view()}, viewable,
+                             "Visibility differs for %s" % name)
+            editable = {id for id, in db.session.query(ThrivResource.id)
+                        .filter(ThrivResource.editable_by(user))}
+            self.assertEqual({r.id for r in resources if r.user_may_edit()}, editable,
+                             "Editability differs for %s" % name)
+            if user is not None:
+                owned = {id for id, in db.session.query(ThrivResource.id)
+                         .filter(ThrivResource.owned_by(user.email))}
+                self.assertEqual({r.id for r in resources if user.email in r.owners()}, owned,
+                                 "Ownership differs for %s" % name)
+        g.user = None
+
+    def test_reindex_swaps_alias_to_new_index(self):
+        self.construct_resource(name="space kittens")
+        old_indices = elastic_index.aliased_indices()
+        self.assertEqual(1, len(old_indices))
+
+        new_index = DataLoader().reindex(keep=1)
+        self.assertEqual([new_index], elastic_index.aliased_indices())
+        self.assertIn(old_indices[0], elastic_index.versioned_indices())
+        search_results = self.search({'query': 'kittens', 'filters': []})
+        self.assertEqual(1, len(search_results["resources"]))
+
+        self.assertEqual(old_indices[0], elastic_index.rollback())
+        self.assertEqual(old_indices, elastic_index.aliased_indices())
+
+    def test_sync_index_upserts_changes_and_removes_deleted(self):
+        r1 = self.construct_resource(name="space kittens")
+        r2 = self.construct_resource(name="space puppies")
+        loader = DataLoader()
+        loader.save_index_watermark(datetime.datetime.now())
+
+        r1.name = "space ferrets"
+        r1.last_updated = datetime.datetime.now()
+        db.session.delete(r2)
+        db.session.commit()
+
+        # Deletions come from tombstones rather than a scan of the index.
+        with patch.object(elastic_index, 'indexed_resource_ids',
+                          side_effect=AssertionError("The whole index was scanned")):
+            self.assertEqual((1, 1), loader.sync_index())
+        self.assertEqual(0, len(self.search({'query': 'kittens'})["resources"]))
+        self.assertEqual(1, len(self.search({'query': 'ferrets'})["resources"]))
+        self.assertEqual({r1.id}, elastic_index.indexed_resource_ids())
+        watermark = loader.get_index_watermark()
+        self.assertIsNotNone(watermark)
+
+        # A removal that fails holds the watermark back, so it is retried next run.
+        db.session.delete(r1)
+        db.session.commit()
+        with patch.object(elastic_index, 'remove_resources',
+                          return_value={r1.id: "Elastic is down"}):
+            self.assertEqual((0, 0), loader.sync_index())
+        self.assertEqual(watermark, loader.get_index_watermark())
+        self.assertEqual((0, 1), loader.sync_index())
+        self.assertEqual(set(), elastic_index.indexed_resource_ids())
+
+    def test_resource_writes_queue_index_changes(self):
+        resource = {'name': "Millennium Falcon", 'description': "Fastest hunk of junk."}
+        rv = self.app.post(
+            '/api/resource',
+            data=json.dumps(resource),
+            content_type="application/json",
+            headers=self.logged_in_headers(),
+            follow_redirects=True)
+        self.assertSuccess(rv)
+        resource_id = json.loads(rv.get_data(as_text=True))['id']
+
+        outbox = db.session.query(IndexOutbox).all()
+        self.assertEqual(1, len(outbox))
+        self.assertEqual(resource_id, outbox[0].resource_id)
+        self.assertEqual(1, IndexOutboxWorker().status()['pending'])
+
+        self.assertEqual(1, IndexOutboxWorker().drain())
+        self.assertEqual(0, db.session.query(IndexOutbox).count())
+        self.assertIn(resource_id, elastic_index.indexed_resource_ids())
+
+    def test_index_outbox_dead_letters_after_max_attempts(self):
+        r = self.construct_resource()
+        db.session.add(IndexOutbox(resource_id=r.id, operation=IndexOutbox.UPDATE))
+        db.session.commit()
+        worker = IndexOutboxWorker(max_attempts=1)
+        original = elastic_index.sync_resources
+        elastic_index.sync_resources = lambda resources, removed: {r.id: "Elastic is down"}
+        try:
+            worker.drain()
+        finally:
+            elastic_index.sync_resources = original
+        status = worker.status()
+        self.assertEqual(0, status['pending'])
+        self.assertEqual(1, status['dead'])
+
+        self.assertEqual(1, worker.requeue_dead())
+        self.assertEqual(1, worker.drain())
+        self.assertEqual(0, db.session.query(IndexOutbox).count())
+
+    def test_search_results_are_cached_per_visibility_class(self):
+        self.construct_resource(name="space kittens", approved="Approved")
+        query = {'query': 'kittens', 'filters': []}
+        search_cache.invalidate()
+
+        def post_search(headers=None):
+            rv = self.app.post('/api/search', data=json.dumps(query),
+                               content_type="application/json", headers=headers)
+            self.assertSuccess(rv)
+            return json.loads(rv.get_data(as_text=True))
+
+        stats = search_cache.stats()
+        first = post_search()
+        self.assertEqual(stats['misses'] + 1, search_cache.stats()['misses'])
+        self.assertEqual(first, post_search())
+        self.assertEqual(stats['hits'] + 1, search_cache.stats()['hits'])
+
+        # Admins are a different visibility class, so they miss.
+        post_search(self.logged_in_headers())
+        self.assertEqual(stats['misses'] + 2, search_cache.stats()['misses'])
+
+        # Only the hits are cached, so a change to a resource shows straight away.
+        kittens = db.session.query(ThrivResource).filter_by(name="space kittens").first()
+        kittens.description = "Fluffy"
+        db.session.commit()
+        self.assertEqual("Fluffy", post_search()['resources'][0]['description'])
+        self.assertEqual(stats['hits'] + 2, search_cache.stats()['hits'])
+
+        # The worker applying a queued change to the index moves the key on, in every
+        # process, but queueing it doesn't.
+        queue_index_update(kittens.id)
+        db.session.commit()
+        post_search()
+        self.assertEqual(stats['hits'] + 3, search_cache.stats()['hits'])
+        IndexOutboxWorker().drain()
+        post_search()
+        self.assertEqual(stats['misses'] + 3, search_cache.stats()['misses'])
+
+    def test_search_cache_is_shared_within_a_visibility_class(self):
+        self.construct_resource(name="space kittens", approved="Approved")
+        self.construct_resource(name="secret kittens", owner="u3@sesamestreet.com")
+        users = [self.construct_user(id=i, eppn="u%i@sesamestreet.com" % i,
+                                     email="u%i@sesamestreet.com" % i) for i in (1, 2, 3)]
+        headers = [self.logged_in_headers(user=user) for user in users]
+        IndexOutboxWorker().drain()
+        search_cache.invalidate()
+        query = {'query': 'kittens', 'filters': []}
+
+        def post_search(headers):
+            rv = self.app.post('/api/search', data=json.dumps(query),
+                               content_type="application/json", headers=headers)
+            self.assertSuccess(rv)
+            return json.loads(rv.get_data(as_text=True))
+
+        stats = search_cache.stats()
+        first = post_search(headers[0])
+        self.assertEqual(1, len(first['resources']))
+        self.assertEqual(first, post_search(headers[1]))
+        self.assertEqual(stats['hits'] + 1, search_cache.stats()['hits'])
+
+        # Owning an unapproved resource sets u3's results apart from the rest of the class.
+        self.assertEqual(2, len(post_search(headers[2])['resources']))
+        self.assertEqual(stats['misses'] + 2, search_cache.stats()['misses'])
+
+    def test_cached_searches_say_what_each_user_may_edit(self):
+        rebels = self.construct_institution(name="Rebels", domain="rebels.org",
+                                            description="Alliance")
+        rogues = self.construct_institution(name="Rogues", domain="rogues.org",
+                                            description="Alliance")
+        self.construct_resource(name="space kittens", approved="Approved",
+                                owner="u1@sesamestreet.com")
+        self.construct_resource(name="secret kittens", approved="Approved",
+                                institution=rebels, private=True)
+        users = [self.construct_user(id=i, eppn="u%i@sesamestreet.com" % i,
+                                     email="u%i@sesamestreet.com" % i) for i in (1, 2)]
+        users += [self.construct_admin_user(id=i, eppn="a%i@sesamestreet.com" % i,
+                                            email="a%i@sesamestreet.com" % i,
+                                            institution=institution)
+                  for i, institution in ((3, rebels), (4, rogues))]
+        search_cache.invalidate()
+        query = {'query': 'kittens', 'filters': []}
+
+        def may_edit(user):
+            rv = self.app.post('/api/search', data=json.dumps(query),
+                               content_type="application/json",
+                               headers=self.logged_in_headers(user=user))
+            self.assertSuccess(rv)
+            response = json.loads(rv.get_data(as_text=True))
+            return {r['name'] for r in response['resources'] if r['user_may_edit']}
+
+        # The owner of a public resource may edit it, others of their class may not.
+        self.assertEqual({"space kittens"}, may_edit(users[0]))
+        self.assertEqual(set(), may_edit(users[1]))
+        # Admins of institutions that share a description see the same resources, but
+        # only the admin of its own institution may edit a private one.
+        self.assertEqual({"space kittens", "secret kittens"}, may_edit(users[2]))
+        self.assertEqual({"space kittens"}, may_edit(users[3]))
+
+    def test_changing_an_institution_description_reindexes_its_resources(self):
+        rebels = self.construct_institution(name="Rebels", domain="rebels.org",
+                                            description="Alliance")
+        rogues = self.construct_institution(name="Rogues", domain="rogues.org",
+                                            description="Alliance")
+        self.construct_resource(name="secret kittens", approved="Approved",
+                                institution=rebels, private=True)
+        user = self.construct_user(institution=rogues)
+        headers = self.logged_in_headers(user=user)
+        query = {'query': 'kittens', 'filters': []}
+
+        def visible():
+            rv = self.app.post('/api/search', data=json.dumps(query),
+                               content_type="application/json", headers=headers)
+            self.assertSuccess(rv)
+            return len(json.loads(rv.get_data(as_text=True))['resources'])
+
+        self.assertEqual(1, visible())
+        rv = self.app.put('/api/institution/%i' % rebels.id,
+                          data=json.dumps({'name': "Rebels", 'description': "Empire"}),
+                          content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertEqual(1, db.session.query(IndexOutbox).count())
+        IndexOutboxWorker().drain()
+        self.assertEqual(0, visible())
+
+        # Other changes to the institution leave the index alone.
+        rv = self.app.put('/api/institution/%i' % rebels.id,
+                          data=json.dumps({'name': "Rebel Alliance", 'description': "Empire"}),
+                          content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertEqual(0, db.session.query(IndexOutbox).count())
+
     def test_create_institution(self):
         institution = {
             "name": "Ender's Academy for wayward space boys",
@@ -1550,6 +2087,61 @@ class TestCase(unittest.TestCase):
         response = json.loads(rv.get_data(as_text=True))
         self.assertEqual("r2", response[0]["resource"]["name"])
 
+    def test_get_resource_by_category_pages_through_viewable_resources(self):
+        c = self.construct_category(name="c1")
+        names = ["r%02i" % i for i in range(12)]
+        for name in names:
+            r = self.construct_resource(name=name, approved="Approved")
+            db.session.add(ResourceCategory(resource=r, category=c))
+        hidden = self.construct_resource(name="r99", approved="Unapproved")
+        db.session.add(ResourceCategory(resource=hidden, category=c))
+        db.session.commit()
+
+        url = '/api/category/%i/resource?sort=name&limit=5' % c.id
+        seen = []
+        while url:
+            rv = self.app.get(url, content_type="application/json")
+            self.assertSuccess(rv)
+            self.assertEqual("12", rv.headers["X-Total-Count"])
+            response = json.loads(rv.get_data(as_text=True))
+            self.assertTrue(len(response) <= 5)
+            seen.extend(rc["resource"]["name"] for rc in response)
+            link = rv.headers.get("Link")
+            url = link[link.index('/api'):link.index('>')] if link else None
+        self.assertEqual(names, seen)
+
+        rv = self.app.get('/api/category/%i/resource?sort=price' % c.id,
+                          content_type="application/json")
+        self.assertEqual(400, rv.status_code)
+        rv = self.app.get('/api/category/%i/resource?after=%i' % (c.id, hidden.id),
+                          content_type="application/json")
+        self.assertEqual(400, rv.status_code)
+
+    def test_resource_cursor_survives_the_last_row_changing(self):
+        c = self.construct_category(name="c1")
+        resources = []
+        for i in range(10):
+            r = self.construct_resource(name="r%02i" % i, approved="Approved")
+            db.session.add(ResourceCategory(resource=r, category=c))
+            resources.append(r)
+        db.session.commit()
+
+        rv = self.app.get('/api/category/%i/resource?sort=name&limit=3' % c.id,
+                          content_type="application/json")
+        self.assertSuccess(rv)
+        link = rv.headers["Link"]
+        self.assertNotIn("after=%i" % resources[2].id, link)
+
+        # The last resource on the page is renamed and the one before it taken out.
+        resources[2].name = "r99"
+        db.session.query(ResourceCategory).filter_by(resource_id=resources[1].id).delete()
+        db.session.commit()
+        rv = self.app.get(link[link.index('/api'):link.index('>')],
+                          content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertEqual(["r03", "r04", "r05"],
+                         [rc["resource"]["name"] for rc in json.loads(rv.get_data(as_text=True))])
+
     def test_category_resource_count(self):
         c = self.construct_category()
         r = self.construct_resource(approved="Approved")
@@ -1562,6 +2154,29 @@ class TestCase(unittest.TestCase):
         response = json.loads(rv.get_data(as_text=True))
         self.assertEqual(1, response["resource_count"])
 
+    def test_category_resource_counts_use_one_query(self):
+        parent = self.construct_category(name="Parent")
+        children = [self.construct_category(name="Child %i" % i, parent=parent) for i in range(5)]
+        for i, child in enumerate(children):
+            r = self.construct_resource(name="r%i" % i, approved="Approved")
+            db.session.add(ResourceCategory(resource=r, category=child))
+        hidden = self.construct_resource(name="hidden", approved="Unapproved", private=True)
+        db.session.add(ResourceCategory(resource=hidden, category=children[0]))
+        db.session.commit()
+
+        counts = ResourceCounts()
+        with self.count_queries() as statements:
+            approved = [counts.approved(c.id) for c in children]
+        self.assertEqual([1, 1, 1, 1, 1], approved)
+        self.assertEqual(1, len(statements))
+        self.assertEqual(5, counts.approved(parent.id, rollup=True))
+
+        g.user = None
+        with self.count_queries() as statements:
+            visible = [counts.visible(c.id) for c in children]
+        self.assertEqual([1, 1, 1, 1, 1], visible)
+        self.assertEqual(1, len(statements))
+
     def test_get_category_by_resource(self):
         c = self.construct_category()
         r = self.construct_resource()
@@ -1869,6 +2484,79 @@ class TestCase(unittest.TestCase):
             '/api/session/favorite', content_type="application/json")
         self.assertEqual(401, rv.status_code)
 
+    def test_favorite_count_is_kept_up_to_date(self):
+        r1 = self.construct_resource(name="r1")
+        r2 = self.construct_resource(name="r2")
+        u1 = self.construct_user(id=1, eppn="u1@sesamestreet.com", email="u1@sesamestreet.com")
+        u2 = self.construct_user(id=2, eppn="u2@sesamestreet.com", email="u2@sesamestreet.com")
+        self.assertEqual(0, r1.favorite_count)
+
+        rv = self.app.post(
+            '/api/favorite',
+            data=json.dumps({"resource_id": r1.id, "user_id": u1.id}),
+            content_type="application/json")
+        self.assertSuccess(rv)
+        favorite_id = json.loads(rv.get_data(as_text=True))["id"]
+        self.assertEqual(1, r1.favorite_count)
+
+        rv = self.app.post(
+            '/api/session/favorite',
+            data=json.dumps([{"resource_id": r1.id}, {"resource_id": r2.id}]),
+            content_type="application/json",
+            headers=self.logged_in_headers(user=u2))
+        self.assertSuccess(rv)
+        self.assertEqual(2, r1.favorite_count)
+        self.assertEqual(1, r2.favorite_count)
+
+        # Replacing a user's favorites recounts the ones they dropped.
+        rv = self.app.post(
+            '/api/session/favorite',
+            data=json.dumps([{"resource_id": r2.id}]),
+            content_type="application/json",
+            headers=self.logged_in_headers(user=u2))
+        self.assertSuccess(rv)
+        self.assertEqual(1, r1.favorite_count)
+        self.assertEqual(1, r2.favorite_count)
+
+        rv = self.app.delete('/api/favorite/%i' % favorite_id)
+        self.assertSuccess(rv)
+        self.assertEqual(0, r1.favorite_count)
+
+        rv = self.app.get('/api/resource/%i' % r2.id, content_type="application/json")
+        self.assertEqual(1, json.loads(rv.get_data(as_text=True))["favorite_count"])
+
+    def test_concurrent_favorites_are_both_counted(self):
+        r = self.construct_resource(name="r1")
+        u1 = self.construct_user(id=1, eppn="u1@sesamestreet.com", email="u1@sesamestreet.com")
+        u2 = self.construct_user(id=2, eppn="u2@sesamestreet.com", email="u2@sesamestreet.com")
+        resource_id, u1_id, u2_id = r.id, u1.id, u2.id
+
+        # The first transaction updates the count and holds the resource's row lock.
+        db.session.add(Favorite(resource_id=resource_id, user_id=u1_id))
+        db.session.flush()
+
+        # The second, in a session of its own, waits for that lock.
+        def favorite():
+            with app.app_context():
+                db.session.add(Favorite(resource_id=resource_id, user_id=u2_id))
+                db.session.commit()
+        other = threading.Thread(target=favorite)
+        other.start()
+        waiting = 0
+        for _ in range(100):
+            waiting = db.session.execute("SELECT count(*) FROM pg_locks WHERE NOT granted").scalar()
+            if waiting:
+                break
+            other.join(0.05)
+        self.assertTrue(waiting, "The second transaction never waited for the first")
+
+        db.session.commit()
+        other.join(10)
+        self.assertFalse(other.is_alive())
+        db.session.expire_all()
+        self.assertEqual(2, db.session.query(ThrivResource.favorite_count)
+                         .filter_by(id=resource_id).scalar())
+
     def test_create_category(self):
         c = {
             "name": "Old bowls",
@@ -2139,6 +2827,20 @@ class TestCase(unittest.TestCase):
         self.assertIsNotNone(dbu.institution)
         self.assertEqual('UVA', dbu.institution.name)
 
+    def test_institution_domains_match_the_most_specific_domain(self):
+        uva = self.construct_institution(name="UVA", domain="virginia.edu")
+        health = self.construct_institution(name="UVA Health", domain="@hscmail.mcc.virginia.edu")
+        self.assertEqual(uva.id, institution_domains.match("dhf8r@virginia.edu"))
+        self.assertEqual(uva.id, institution_domains.match("dhf8r@eservices.Virginia.EDU"))
+        self.assertEqual(health.id, institution_domains.match("dhf8r@hscmail.mcc.virginia.edu"))
+        with self.count_queries() as statements:
+            self.assertIsNone(institution_domains.match("dhf8r@westvirginia.edu"))
+            self.assertIsNone(institution_domains.match("dhf8r"))
+        self.assertEqual(0, len(statements))
+
+        vt = self.construct_institution(name="Virginia Tech", domain="vt.edu")
+        self.assertEqual(vt.id, institution_domains.match("hokie@vt.edu"))
+
     def test_sso_login_with_existing_email_address_doesnt_bomb_out(self):
         # There is an existing user in the database, but it has no eppn.
         user = User(
@@ -2199,6 +2901,48 @@ class TestCase(unittest.TestCase):
 
         return user
 
+    def test_login_rehashes_passwords_made_with_another_work_factor(self):
+        user = self.construct_user(email="arya@got.com", eppn="arya@got.com")
+        user._password = bcrypt.generate_password_hash("valar morghulis", 4)
+        user.email_verified = True
+        db.session.commit()
+        self.assertTrue(user.password_needs_rehash())
+
+        rv = self.app.post(
+            '/api/login_password',
+            data=json.dumps({"email": "arya@got.com", "password": "valar morghulis"}),
+            content_type="application/json")
+        self.assertSuccess(rv)
+        user = User.query.filter_by(email="arya@got.com").first()
+        self.assertFalse(user.password_needs_rehash())
+        self.assertTrue(user.is_correct_password("valar morghulis"))
+        self.assertTrue(password_hasher.stats()['check']['count'] > 0)
+
+    def test_password_hashing_rejects_calls_when_saturated(self):
+        settings = app.config.get('PASSWORD_HASHING')
+        app.config['PASSWORD_HASHING'] = {'workers': 1, 'max_pending': 0}
+        try:
+            hasher = PasswordHasher(app, bcrypt)
+        finally:
+            app.config['PASSWORD_HASHING'] = settings
+        started, release = threading.Event(), threading.Event()
+
+        def busy():
+            started.set()
+            release.wait()
+        worker = threading.Thread(target=hasher._run, args=('hash', busy))
+        worker.start()
+        started.wait()
+        try:
+            with self.assertRaises(RestException) as context:
+                hasher.hash("hodor")
+            self.assertEqual(503, context.exception.status_code)
+            self.assertEqual(1, hasher.stats()['rejected'])
+        finally:
+            release.set()
+            worker.join()
+        self.assertTrue(hasher.check(hasher.hash("hodor"), "hodor"))
+
     def test_logout_user(self, display_name="Emilia Clarke", eppn="daeneryst@got.com",
                                        email="daeneryst@got.com", role="User", password="5t0rmb0r~"):
         user = self.test_login_user(display_name=display_name, eppn=eppn,
@@ -2251,6 +2995,54 @@ class TestCase(unittest.TestCase):
             headers=self.logged_in_headers(user=admin_user))
         self.assertSuccess(rv)
 
+    def test_authenticated_requests_use_the_principal_cache(self):
+        admin_user = self.construct_admin_user()
+        user = self.construct_user()
+        headers = self.logged_in_headers(user=user)
+        rv = self.app.get('/api/session/favorite', headers=headers)
+        self.assertSuccess(rv)
+
+        with self.count_queries() as statements:
+            rv = self.app.get('/api/session/favorite', headers=headers)
+        self.assertSuccess(rv)
+        self.assertEqual([], [s for s in statements
+                              if 'FROM ithriv_user' in s or 'data_version' in s])
+
+        # Changes to other users, or to what isn't kept, leave the principal cached
+        admin_user.role = 'User'
+        user.display_name = 'Poe'
+        db.session.commit()
+        with self.count_queries() as statements:
+            rv = self.app.get('/api/session/favorite', headers=headers)
+        self.assertSuccess(rv)
+        self.assertEqual([], [s for s in statements if 'FROM ithriv_user' in s])
+        admin_user.role = 'Admin'
+        db.session.commit()
+
+        # Changing a user through the API takes effect on their next request
+        rv = self.app.get('/api/user', headers=headers)
+        self.assertEqual(403, rv.status_code)
+        data = UserSchema().dump(user).data
+        data['role'] = 'Admin'
+        rv = self.app.put('/api/user/%i' % user.id, data=json.dumps(data),
+                          content_type="application/json",
+                          headers=self.logged_in_headers(user=admin_user))
+        self.assertSuccess(rv)
+        rv = self.app.get('/api/user', headers=headers)
+        self.assertSuccess(rv)
+
+        # As do bulk updates, which drop every principal this process holds
+        db.session.query(User).filter_by(id=user.id).update({'role': 'User'})
+        db.session.commit()
+        rv = self.app.get('/api/user', headers=headers)
+        self.assertEqual(403, rv.status_code)
+
+        # And deleting the user
+        db.session.query(User).filter_by(id=user.id).delete()
+        db.session.commit()
+        rv = self.app.get('/api/session/favorite', headers=headers)
+        self.assertEqual(401, rv.status_code)
+
     def decode(self, encoded_words):
         """
         Useful for checking the content of email messages
@@ -2539,6 +3331,136 @@ class TestCase(unittest.TestCase):
         result = json.loads(rv.get_data(as_text=True))
         self.assertEqual(5, len(result))
 
+    def test_resource_list_pages_with_a_cursor(self):
+        events = ThrivSegment(name="Event")
+        education = ThrivSegment(name="Education")
+        now = datetime.datetime.utcnow()
+        for i in range(7):
+            r = self.construct_resource(name="Lesson %i" % i, approved="Approved")
+            r.segment = education
+            r.last_updated = now - datetime.timedelta(days=i % 3)
+            e = self.construct_resource(name="Event %i" % i, approved="Approved")
+            e.segment = events
+            e.starts = now + datetime.timedelta(days=7 - i)
+            e.ends = e.starts + datetime.timedelta(hours=1)
+        past = self.construct_resource(name="Yesterday's news", approved="Approved")
+        past.segment = events
+        past.starts = now - datetime.timedelta(days=2)
+        past.ends = now - datetime.timedelta(days=1)
+        db.session.commit()
+
+        def read_all(query_string):
+            url, names = '/api/resource?' + query_string, []
+            while url:
+                rv = self.app.get(url, content_type="application/json")
+                self.assertSuccess(rv)
+                page = json.loads(rv.get_data(as_text=True))
+                self.assertTrue(len(page) <= 3)
+                names.extend(r["name"] for r in page)
+                link = rv.headers.get("Link")
+                url = link[link.index('/api'):link.index('>')] if link else None
+            return names
+
+        lessons = read_all('segment=Education&limit=3')
+        self.assertEqual(7, len(set(lessons)))
+        self.assertEqual(["Lesson 6", "Lesson 3", "Lesson 0"], lessons[:3])
+        self.assertEqual(["Event %i" % i for i in reversed(range(7))],
+                         read_all('segment=Event&limit=3'))
+        self.assertEqual(15, len(set(read_all('limit=3'))))
+
+        rv = self.app.get('/api/resource?limit=ten', content_type="application/json")
+        self.assertEqual(400, rv.status_code)
+        rv = self.app.get('/api/resource?after=1', content_type="application/json")
+        self.assertEqual(400, rv.status_code)
+
+        # The next page stays put when the last event on this one is moved.
+        rv = self.app.get('/api/resource?segment=Event&limit=3', content_type="application/json")
+        link = rv.headers["Link"]
+        moved = db.session.query(ThrivResource).filter_by(name="Event 4").first()
+        moved.starts = now + datetime.timedelta(days=30)
+        moved.ends = moved.starts + datetime.timedelta(hours=1)
+        db.session.commit()
+        rv = self.app.get(link[link.index('/api'):link.index('>')],
+                          content_type="application/json")
+        self.assertEqual(["Event 3", "Event 2", "Event 1"],
+                         [r["name"] for r in json.loads(rv.get_data(as_text=True))])
+
+    def test_resource_fields_and_include_limit_what_is_loaded(self):
+        for i in range(5):
+            self.construct_resource(name="Resource %i" % i, approved="Approved")
+
+        with self.count_queries() as full:
+            rv = self.app.get('/api/resource', content_type="application/json")
+        self.assertSuccess(rv)
+        self.assertIn("resource_categories", json.loads(rv.get_data(as_text=True))[0])
+
+        with self.count_queries() as sparse:
+            rv = self.app.get('/api/resource?fields=name,type', content_type="application/json")
+        self.assertSuccess(rv)
+        response = json.loads(rv.get_data(as_text=True))
+        self.assertEqual(5, len(response))
+        self.assertEqual({"id", "name", "type"}, set(response[0].keys()))
+        self.assertEqual("Starfighter", response[0]["type"]["name"])
+        self.assertLess(len(sparse), len(full))
+
+        rv = self.app.get('/api/resource/%i?include=type' % response[0]["id"],
+                          content_type="application/json")
+        self.assertSuccess(rv)
+        response = json.loads(rv.get_data(as_text=True))
+        self.assertIn("description", response)
+        self.assertIn("type", response)
+        self.assertNotIn("resource_categories", response)
+        self.assertNotIn("institution", response)
+
+        rv = self.app.get('/api/resource?fields=name,password', content_type="application/json")
+        self.assertEqual(400, rv.status_code)
+
+    def test_response_encoder_writes_compact_utf8_json_with_either_backend(self):
+        from flask_restful.representations.json import output_json
+        self.assertEqual('orjson', response_encoder.backend)
+        settings = app.config.get('RESPONSE_ENCODER')
+        app.config['RESPONSE_ENCODER'] = {'backend': 'json', 'stream_threshold': 2, 'chunk_size': 2}
+        try:
+            encoder = ResponseEncoder(app)
+        finally:
+            app.config['RESPONSE_ENCODER'] = settings
+
+        # The output contract, pinned byte for byte.
+        data = [{"id": 1, "name": "Résource", "private": False, "ends": None},
+                {"id": 2, "tags": ["a", "b"], "cost": 1.5}]
+        expected = b'[{"id":1,"name":"R\xc3\xa9source","private":false,"ends":null},' \
+                   b'{"id":2,"tags":["a","b"],"cost":1.5}]\n'
+        for backend in ResponseEncoder.BACKENDS:
+            encoder.backend = backend
+            self.assertEqual(expected, encoder.dumps(data), backend)
+            self.assertEqual(expected, b"".join(encoder.chunks(data)), backend)
+
+        # Resources come out as the same documents flask_restful sent.
+        for i in range(5):
+            self.construct_resource(name="Résource %i" % i, approved="Approved")
+        data = ThrivResourceSchema(many=True).dump(db.session.query(ThrivResource).all()).data
+        bodies = set()
+        for backend in ResponseEncoder.BACKENDS:
+            encoder.backend = backend
+            streamed = encoder.output_json(data, 200)
+            self.assertTrue(streamed.is_streamed)
+            bodies.update([encoder.dumps(data), streamed.get_data()])
+        self.assertEqual(1, len(bodies))
+        self.assertEqual(json.loads(output_json(data, 200).get_data()), json.loads(bodies.pop()))
+
+    def test_search_responses_go_through_the_response_encoder(self):
+        self.construct_resource(name="Résource kittens", approved="Approved")
+        query = {'query': 'kittens', 'filters': []}
+        search_cache.invalidate()
+        for _ in range(2):
+            with patch.object(response_encoder, 'dumps',
+                              wraps=response_encoder.dumps) as dumps:
+                rv = self.app.post('/api/search', data=json.dumps(query),
+                                   content_type="application/json")
+            self.assertSuccess(rv)
+            self.assertTrue(dumps.called)
+            self.assertIn('"name":"Résource kittens"'.encode('utf-8'), rv.get_data())
+
     def test_private_resources_not_listed_for_anonymous_user(self):
         resources = self.construct_various_resources()
         self.assertEqual(16, len(resources))